@@ -0,0 +1,679 @@
+############################################################
+# Benchmark suite for the interpreters in this directory
+#
+# Runs the same guest programs (fib, sum, curry/map, while loops
+# over reference cells, array quicksort, the sample-*.pj files)
+# on every evaluator whose surface syntax can express them, and
+# reports wall time, evaluation steps and peak memory as JSON
+#
+#   python benchmark.py [-o results.json] [--repeat N]
+#                       [--evaluator E ...] [--program P ...]
+#   python benchmark.py --compare old.json new.json
+#   python benchmark.py --micro NAME ...
+#
+# Every (evaluator, program) case runs in its own Python process so
+# that peak memory belongs to that case alone. Only evaluation is
+# timed: parsing, type checking and top-level definitions are setup.
+#
+# steps are the lines of interpreter code executed while evaluating
+# the program once (a sys.settrace count restricted to the file of
+# the evaluator); unlike wall time they do not depend on the machine
+#
+# --compare reports cases whose time or memory grew by more than
+# --threshold, or whose step count or status changed, and exits
+# with status 1 if there are any
+#
+# --micro runs micro-benchmarks of parts of final.py instead, each
+# printing its own table (see MICRO below)
+
+import sys
+import os
+import ast
+import imp
+import glob
+import json
+import time
+import resource
+import platform
+import argparse
+import threading
+import subprocess
+from StringIO import StringIO
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+############################################################
+# guest programs
+#
+# each program maps a surface syntax to its source:
+#   "func"  - untyped S-expressions with defun (homework3-5)
+#   "typed" - S-expressions with type annotations (lecture 10, final)
+#   "poly"  - the same with generic types and working while loops (final)
+#   "imp"   - the imp language of homework6
+#   "pj"    - the C-like language of homework7, run through main()
+#   "ast"   - a call to a function of the homework2 FUN_DICT
+#
+# S-expression sources are lists of top-level forms, the last one
+# is the expression whose value is the result; imp and pj programs
+# print their result, so the result is the last line printed
+
+SUM_N = 100
+FIB_N = 15
+WHILE_N = 300
+SORT_N = 40
+
+def sort_input (n):
+    # the same pseudo-random array for every run
+    return [ (i * 7919) % 97 for i in range(n) ]
+
+def pj_array (values):
+    return "[{}]".format(", ".join([ str(v) for v in values ]))
+
+def imp_array (name,values):
+    # homework6 arrays can only be updated at literal indices
+    return ["var {} = (new-array {});".format(name,len(values))] + [
+        "{}[{}] <- {};".format(name,i,v) for (i,v) in enumerate(values) ]
+
+PROGRAMS = [
+    {"name": "sum",
+     "expect": str(SUM_N * (SUM_N + 1) / 2),
+     "ast": ("sum_from_to", [0, SUM_N]),
+     "func": ["(defun sum (n) (if (zero? n) 0 (+ n (sum (- n 1)))))",
+              "(sum {})".format(SUM_N)],
+     "typed": ["(defun sum (n) (int) (if (zero? n) 0 (+ n (sum (- n 1)))))",
+               "(sum {})".format(SUM_N)],
+     "pj": """
+def sum (n) { if (n == 0) { 0; } else { n + sum(n - 1); } }
+def main () { print sum(%d); }
+""" % SUM_N},
+
+    {"name": "fib",
+     "expect": "987",
+     "func": ["(defun fib (n) (if (zero? n) 1 (if (zero? (- n 1)) 1 (+ (fib (- n 1)) (fib (- n 2))))))",
+              "(fib {})".format(FIB_N)],
+     "typed": ["(defun fib (n) (int) (if (zero? n) 1 (if (zero? (- n 1)) 1 (+ (fib (- n 1)) (fib (- n 2))))))",
+               "(fib {})".format(FIB_N)],
+     "pj": """
+def fib (n) { if (n < 2) { 1; } else { var a = fib(n - 1); var b = fib(n - 2); a + b; } }
+def main () { print fib(%d); }
+""" % FIB_N},
+
+    # the curry, pair and map examples of final.py
+    {"name": "curry",
+     "expect": "10200",
+     "poly": ["(defun curry (f) ((-> (<S> <T>) <U>)) (function (a) (<S>) (function (b) (<T>) (f a b))))",
+              "(defun pair (x y) (<T> <S>) (function (f) ((-> (<T> <S>) <U>)) (f x y)))",
+              "(defun add1 (a) (int) (+ a 1))",
+              "(defun map2 (a b) ((-> (<T>) <S>) <T>) (a b))",
+              "(defun run (n) (int) (if (zero? n) 0 (+ (((curry +) n) ((pair 1 (map2 add1 n)) *)) (run (- n 1)))))",
+              "(run 100)"]},
+
+    {"name": "while",
+     "expect": str(WHILE_N * (WHILE_N - 1) / 2),
+     "poly": ["(defun loop (n) (int) (let ((i (ref 0)) (s (ref 0))) ((ref int) (ref int)) (do (while (if (zero? (- (deref i) n)) false true) (do (update! s (+ (deref s) (deref i))) (update! i (+ (deref i) 1)))) (deref s))))",
+              "(loop {})".format(WHILE_N)],
+     "imp": ["var i = 0;",
+             "var s = 0;",
+             "while (< i {}) {{ s <- (+ s i); i <- (+ i 1); }}".format(WHILE_N),
+             "print s;"],
+     "pj": """
+def loop (n) {
+  var i = 0;
+  var s = 0;
+  while (i < n) {
+    s = s + i;
+    i = i + 1;
+  }
+  s;
+}
+def main () { print loop(%d); }
+""" % WHILE_N},
+
+    # the quicksort of the homework6 docstring, with the last element
+    # as the pivot instead of a random one
+    {"name": "quicksort",
+     "expect": str(max(sort_input(SORT_N))),
+     "imp": imp_array("a",sort_input(SORT_N)) + [
+         "procedure swap (a f l) (with a (swap f l));",
+         "procedure quickSortDiv (a f l) if (<= f (- l 1)) { var pivot = f; "
+         "for var i = f; (!= l i); i <- (+ i 1); "
+         "if (<= (with a (index i)) (with a (index l))) { swap(a pivot i); pivot <- (+ 1 pivot); } "
+         "swap(a pivot l); quickSortDiv(a f (- pivot 1)); quickSortDiv(a (+ pivot 1) l); }",
+         "procedure quicksort (a) quickSortDiv(a 0 (- (with a (length)) 1));",
+         "quicksort(a);",
+         "print (with a (index {}));".format(SORT_N - 1)],
+     "pj": """
+def swap (a, i, j) {
+  var t = a[i];
+  a[i] = a[j];
+  a[j] = t;
+}
+
+def quicksort (a, lo, hi) {
+  var p = lo;
+  var i = lo;
+  if (lo < hi) {
+    while (i < hi) {
+      if (a[i] <= a[hi]) {
+        swap(a, i, p);
+        p = p + 1;
+      }
+      i = i + 1;
+    }
+    swap(a, p, hi);
+    quicksort(a, lo, p - 1);
+    quicksort(a, p + 1, hi);
+  }
+}
+
+def sort (a) {
+  var n = len(a);
+  quicksort(a, 0, n - 1);
+}
+
+def main () {
+  var a = %s;
+  sort(a);
+  print a[%d];
+}
+""" % (pj_array(sort_input(SORT_N)), SORT_N - 1)},
+]
+
+# the sample programs of homework7, as they are
+for path in sorted(glob.glob(os.path.join(HERE,"sample-*.pj"))):
+    with open(path) as f:
+        PROGRAMS.append({"name": os.path.basename(path)[:-3],
+                         "expect": None,
+                         "pj": f.read()})
+
+
+############################################################
+# evaluators
+#
+# each evaluator is a module of this directory, the syntaxes it reads
+# (the first one a program is written in is used) and a function that
+# takes the module and a program source, does the setup, and returns
+# a function evaluating the program and returning its result
+
+def load_module (filename):
+    # execute a module without starting its shell: the homework files
+    # call their shell at the top level, so drop those calls first
+    path = os.path.join(HERE,filename)
+    with open(path) as f:
+        tree = ast.parse(f.read(),path)
+    body = []
+    for node in tree.body:
+        if (isinstance(node,ast.Expr) and isinstance(node.value,ast.Call)
+                and isinstance(node.value.func,ast.Name)
+                and node.value.func.id.startswith("shell")):
+            continue
+        if (isinstance(node,ast.If) and isinstance(node.test,ast.Compare)
+                and isinstance(node.test.left,ast.Name)
+                and node.test.left.id == "__name__"):
+            continue
+        body.append(node)
+    tree.body = body
+    name = os.path.splitext(filename)[0].replace("-","_")
+    module = imp.new_module(name)
+    module.__file__ = path
+    sys.modules[name] = module
+    exec compile(tree,path,"exec") in module.__dict__
+    return module
+
+def setup_ast (m,source):
+    (name,args) = source
+    exp = m.ECall(name,[ m.EInteger(v) for v in args ])
+    return lambda: exp.eval(m.INITIAL_PRIM_DICT,m.FUN_DICT).value
+
+def setup_subst (m,source):
+    # homework3: functions live in a dictionary, calls substitute
+    fun_dict = m.INITIAL_FUN_DICT.copy()
+    for form in source[:-1]:
+        result = m.parse(form)
+        fun_dict[result["name"]] = result
+    exp = m.parse(source[-1])["expr"]
+    return lambda: exp.eval(fun_dict).value
+
+def setup_env (m,source):
+    # homework4: functions in a dictionary, arguments in an environment
+    fun_dict = m.INITIAL_FUN_DICT.copy()
+    for form in source[:-1]:
+        result = m.parse(form)
+        fun_dict[result["name"]] = result
+    exp = m.parse(source[-1])["expr"]
+    return lambda: exp.evalEnv(fun_dict,[]).value
+
+def setup_closure (m,source):
+    # homework5: top-level closures share the top-level environment
+    env = m.initial_env()
+    for form in source[:-1]:
+        result = m.parse(form)
+        env.insert(0,(result["name"],m.VClosure(result["params"],result["body"],env)))
+    exp = m.parse(source[-1])["expr"]
+    return lambda: exp.eval(env).value
+
+def setup_typed (m,source):
+    # lecture 10: type check and define like its shell does
+    env = m.initial_env()
+    symt = m.initial_symtable()
+    for form in source[:-1]:
+        result = m.parse(form)
+        f = m.EFunction(result["params"],result["body"],types=result["types"],name=result["name"])
+        t = f.typecheck(symt)
+        env = m.add_binding(result["name"],f.eval(env),env)
+        symt = m.add_binding(result["name"],t,symt)
+    exp = m.parse(source[-1])["expr"]
+    exp.typecheck(symt)
+    return lambda: exp.eval(env).value
+
+def setup_final (engine):
+    # final.py: type inference and optimize(), then the given engine
+    # (the typecheck() checker fails on curry, whose result is a function:
+    # transform_type() gives it the result type TNone, the class)
+    def setup (m,source):
+        forms = m.parse_program("\n".join(source))
+        symt = m.initial_symtable()
+        env = m.initial_frame_env() if engine in m.FRAME_ENGINES else m.initial_env()
+        for result in forms[:-1]:
+            t = m.typecheck_top(result["fun"],symt,"infer")
+            symt = symt.set(result["name"],t)
+            env = m.define_top(result["name"],m.eval_top(result["fun"],env,engine,optimize=True,typ=t),env,engine)
+        m.typecheck_top(forms[-1]["expr"],symt,"infer")
+        exp = m.optimize_top(forms[-1]["expr"],env,engine)
+        return lambda: m.eval_top(exp,env,engine).value
+    return setup
+
+def last_line (output):
+    lines = output.getvalue().strip().splitlines()
+    return lines[-1].strip() if lines else None
+
+def setup_imp (m,source):
+    # homework6: declarations and statements, one at a time
+    env = m.initial_env_imp()
+    stmts = []
+    for form in source:
+        result = m.parse_imp(form)
+        if result["result"] == "declaration":
+            (name,exp) = result["decl"]
+            env.insert(0,(name,m.VRefCell(exp.eval(env))))
+        else:
+            stmts.append(result["stmt"])
+    def run ():
+        for stmt in stmts:
+            stmt.eval(env)
+        return last_line(sys.stdout)
+    return run
+
+def setup_pj (m,source):
+    # homework7: declare everything in the file, then call main()
+    env = m.initial_env_imp()
+    for result in m.parse_imp(source):
+        if result["result"] == "statement":
+            result["stmt"].eval(env)
+        elif result["result"] == "declaration" and result["decl"] != ";":
+            (name,exp) = result["decl"]
+            env.insert(0,(name,m.VRefCell(exp.eval(env))))
+    main = m.parse_imp("main();")[0]["stmt"]
+    def run ():
+        main.eval(env)
+        return last_line(sys.stdout)
+    return run
+
+EVALUATORS = [
+    ("homework2", "homework2.py", ("ast",), setup_ast),
+    ("homework3", "homework3.py", ("func",), setup_subst),
+    ("hw3test", "hw3test.py", ("func",), setup_subst),
+    ("homework4", "homework4.py", ("func",), setup_env),
+    ("homework5", "homework5.py", ("func",), setup_closure),
+    ("homework6", "homework6.py", ("imp",), setup_imp),
+    ("homework7", "homework7.py", ("pj",), setup_pj),
+    ("lecture10", "code-lect-10-types.py", ("typed",), setup_typed),
+    ("final-iter", "final.py", ("poly","typed"), setup_final("iter")),
+    ("final-cont", "final.py", ("poly","typed"), setup_final("cont")),
+    ("final-need", "final.py", ("poly","typed"), setup_final("need")),
+    ("final-frame", "final.py", ("poly","typed"), setup_final("frame")),
+    ("final-closure", "final.py", ("poly","typed"), setup_final("closure")),
+    ("final-vm", "final.py", ("poly","typed"), setup_final("vm")),
+    ("final-unboxed", "final.py", ("poly","typed"), setup_final("unboxed")),
+]
+
+def find_evaluator (name):
+    for evaluator in EVALUATORS:
+        if evaluator[0] == name:
+            return evaluator
+    raise Exception("Unknown evaluator {}".format(name))
+
+def find_program (name):
+    for program in PROGRAMS:
+        if program["name"] == name:
+            return program
+    raise Exception("Unknown program {}".format(name))
+
+def program_syntax (program,syntaxes):
+    for syntax in syntaxes:
+        if syntax in program:
+            return syntax
+    return None
+
+def cases (evaluators=None,programs=None):
+    # every program on every evaluator whose syntax it is written in
+    for (name,filename,syntaxes,setup) in EVALUATORS:
+        if evaluators and name not in evaluators:
+            continue
+        for program in PROGRAMS:
+            if programs and program["name"] not in programs:
+                continue
+            if program_syntax(program,syntaxes):
+                yield (name,program["name"])
+
+
+############################################################
+# running one case (in a child process)
+
+def count_lines (filename,thunk):
+    # run thunk, counting the lines executed in filename
+    counter = [0]
+    def trace_line (frame,event,arg):
+        if event == "line":
+            counter[0] += 1
+        return trace_line
+    def trace_call (frame,event,arg):
+        if frame.f_code.co_filename == filename:
+            return trace_line
+        return None
+    sys.settrace(trace_call)
+    try:
+        thunk()
+    finally:
+        sys.settrace(None)
+    return counter[0]
+
+def peak_kb ():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def run_case (evaluator_name,program_name,repeat):
+    (name,filename,syntaxes,setup) = find_evaluator(evaluator_name)
+    program = find_program(program_name)
+    syntax = program_syntax(program,syntaxes)
+    record = {"evaluator":name, "program":program_name}
+    saved_stdout = sys.stdout
+    try:
+        sys.stdout = StringIO()
+        m = load_module(filename)
+        record["base_kb"] = peak_kb()
+        times = []
+        for i in range(repeat):
+            # fresh setup every time: programs may update their arrays and cells
+            run = setup(m,program[syntax])
+            sys.stdout = StringIO()
+            start = time.time()
+            result = run()
+            times.append(time.time() - start)
+        sys.stdout = StringIO()
+        record["steps"] = count_lines(m.__file__,setup(m,program[syntax]))
+        times.sort()
+        record["wall"] = times[len(times) / 2]
+        record["wall_min"] = times[0]
+        record["result"] = str(result)
+        if program["expect"] is None or str(result) == program["expect"]:
+            record["status"] = "ok"
+        else:
+            record["status"] = "wrong"
+    except Exception as e:
+        record["status"] = "error"
+        record["error"] = "{}: {}".format(type(e).__name__,e)
+    finally:
+        sys.stdout = saved_stdout
+    record["peak_kb"] = peak_kb()
+    return record
+
+def run_case_deep (evaluator_name,program_name,repeat):
+    # the recursive evaluators need a deep Python stack
+    sys.setrecursionlimit(100000)
+    threading.stack_size(512 * 1024 * 1024)
+    records = []
+    thread = threading.Thread(target=lambda: records.append(run_case(evaluator_name,program_name,repeat)))
+    thread.start()
+    thread.join()
+    return records[0]
+
+
+############################################################
+# running the suite
+
+def spawn_case (evaluator_name,program_name,repeat):
+    proc = subprocess.Popen([sys.executable,os.path.abspath(__file__),
+                             "--case",evaluator_name,program_name,
+                             "--repeat",str(repeat)],
+                            stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+    (out,err) = proc.communicate()
+    try:
+        return json.loads(out.strip().splitlines()[-1])
+    except (ValueError,IndexError):
+        return {"evaluator":evaluator_name, "program":program_name,
+                "status":"error", "error":"process failed: {}".format(err.strip()[-500:])}
+
+def run_suite (evaluators,programs,repeat):
+    results = []
+    for (evaluator_name,program_name) in cases(evaluators,programs):
+        record = spawn_case(evaluator_name,program_name,repeat)
+        print >> sys.stderr, "{:<14} {:<18} {:<6} {}".format(
+            evaluator_name,program_name,record["status"],
+            "{:.4f}s".format(record["wall"]) if "wall" in record else record.get("error",""))
+        results.append(record)
+    return {"date": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "repeat": repeat,
+            "results": results}
+
+
+############################################################
+# comparing two runs
+
+def compare (old,new,threshold):
+    # returns the list of regressions of new with respect to old
+    regressions = []
+    before = dict([ ((r["evaluator"],r["program"]),r) for r in old["results"] ])
+    for r in new["results"]:
+        key = (r["evaluator"],r["program"])
+        if key not in before:
+            continue
+        o = before[key]
+        what = "{} {}".format(*key)
+        if o["status"] != r["status"]:
+            regressions.append("{}: status {} -> {}".format(what,o["status"],r["status"]))
+        if r["status"] != "ok" or o["status"] != "ok":
+            continue
+        if r["steps"] != o["steps"]:
+            regressions.append("{}: steps {} -> {}".format(what,o["steps"],r["steps"]))
+        if r["wall"] > o["wall"] * threshold:
+            regressions.append("{}: time {:.4f}s -> {:.4f}s".format(what,o["wall"],r["wall"]))
+        grown = r["peak_kb"] - r["base_kb"]
+        if grown > max(o["peak_kb"] - o["base_kb"],1024) * threshold:
+            regressions.append("{}: memory +{}kB -> +{}kB".format(what,o["peak_kb"] - o["base_kb"],grown))
+    return regressions
+
+
+############################################################
+# micro-benchmarks of final.py
+#
+# each one takes the final.py module and prints a small table comparing
+# one of its data structures or evaluators with what it replaced
+
+def micro_cont (m,n=5000,repeat=3):
+    # compare eval_cont against eval_iter on non-tail recursion
+    # n has to stay below what the Python stack allows eval_iter
+    env = m.initial_env()
+    for src in ["(defun sumto (n) (int) (if (zero? n) 0 (+ n (sumto (- n 1)))))",
+                "(defun loop (n) (int) (if (zero? n) 0 (loop (- n 1))))"]:
+        result = m.parse(src)
+        f = m.EFunction(result["params"],result["body"],types=result["types"],name=result["name"])
+        env = m.add_binding(result["name"],f.eval(env),env)
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(limit,20*n))
+    try:
+        for call in ["(sumto {})","(loop {})"]:
+            exp = m.parse(call.format(n))["expr"]
+            for (name,evaluate) in [("eval_iter",m.eval_iter),("eval_cont",m.eval_cont)]:
+                best = None
+                for i in range(repeat):
+                    start = time.time()
+                    evaluate(exp,env)
+                    t = time.time() - start
+                    if best is None or t < best:
+                        best = t
+                print "{:<16}{:<10}{:.3f}s".format(call.format(n),name,best)
+    finally:
+        sys.setrecursionlimit(limit)
+
+def micro_symtable (m,n=5000):
+    # compare association lists against PMap for n top-level bindings,
+    # each followed by lookups of ten names defined so far
+    names = [ "f{}".format(i) for i in range(n) ]
+    start = time.time()
+    table = m.PMap()
+    for (i,name) in enumerate(names):
+        table = table.set(name,i)
+        for other in names[:i+1:i/10+1]:
+            table.get(other)
+    print "{:<6}{:<8}{:.3f}s".format(n,"PMap",time.time() - start)
+    start = time.time()
+    table = []
+    for (i,name) in enumerate(names):
+        table = table + [(name,i)]
+        for other in names[:i+1:i/10+1]:
+            for (k,v) in reversed(table):
+                if k == other:
+                    break
+    print "{:<6}{:<8}{:.3f}s".format(n,"list",time.time() - start)
+
+def micro_values (m,n=1000):
+    # memory per value and allocations of value objects in an arithmetic
+    # loop, compared with the previous representation (a __dict__ and a
+    # type object per value)
+    # tracemalloc does not exist in Python 2, so sizes come from sys.getsizeof
+    class DictType (object):
+        def __init__ (self):
+            self.type = "integer"
+    class DictInteger (object):
+        def __init__ (self,i):
+            self.value = i
+            self.type = DictType()
+    def size (v):
+        total = sys.getsizeof(v)
+        if hasattr(v,"__dict__"):
+            total += sys.getsizeof(v.__dict__)
+            if isinstance(v.type,DictType):
+                total += sys.getsizeof(v.type) + sys.getsizeof(v.type.__dict__)
+        return total
+    print "{:<28}{} bytes".format("VInteger, previous layout",size(DictInteger(100000)))
+    print "{:<28}{} bytes".format("VInteger",size(m.VInteger(100000)))
+    print "{:<28}{} bytes (shared)".format("VInteger, small",size(m.VInteger(10)))
+    # count down from n, adding up the counter; keeping every result
+    # alive means distinct ids are distinct objects, and the ones that
+    # are not preallocated were allocated by the loop
+    results = []
+    one = m.VInteger(1)
+    acc = m.VInteger(0)
+    i = m.VInteger(n)
+    while True:
+        done = m.oper_zero(i)
+        results.append(done)
+        if done.value:
+            break
+        acc = m.oper_plus(acc,m.oper_times(i,one))
+        i = m.oper_minus(i,one)
+        results.extend([acc,i])
+    shared = set([ id(v) for v in m.SMALL_INTS + [m.TRUE,m.FALSE] ])
+    allocated = len(set([ id(v) for v in results ]) - shared)
+    print "{:<28}{} objects for {} results".format("loop allocations",allocated,len(results))
+
+def micro_parse (m,sizes=(10000,100000,1000000)):
+    # parse throughput of both parsers on generated programs of about
+    # size bytes; pyparsing is only timed up to 100000 bytes, it takes
+    # minutes beyond
+    forms = ["(defun f{0} (a b) (int bool) (if b (let ((x (+ a {0}))) (int) (* x x)) (f{0} (- a 1) (zero? a))))",
+             "(define v{0} (do (print! {0}) ((function (r) ((ref int)) (deref r)) (ref {0}))))",
+             "(defun g{0} (h) ((-> (int) <T>)) (while (zero? 1) (h {0})))"]
+    for size in sizes:
+        lines = []
+        length = 0
+        while length < size:
+            line = forms[len(lines) % len(forms)].format(len(lines))
+            lines.append(line)
+            length += len(line) + 1
+        input = "\n".join(lines)
+        for name in m.PARSERS:
+            if name == "pyparsing" and size > 100000:
+                continue
+            start = time.time()
+            m.parse_program(input,name)
+            t = time.time() - start
+            print "{:<10}{:>9} bytes {:>7} forms {:8.3f}s {:10.0f} bytes/s".format(name,len(input),len(lines),t,len(input)/t)
+
+MICRO = [
+    ("cont", micro_cont),
+    ("symtable", micro_symtable),
+    ("values", micro_values),
+    ("parse", micro_parse),
+]
+
+def run_micro (names):
+    m = load_module("final.py")
+    for (name,bench) in MICRO:
+        if name in names:
+            print "#", name
+            bench(m)
+
+
+def main (argv):
+    parser = argparse.ArgumentParser(description="Benchmark the interpreters in this directory")
+    parser.add_argument("-o","--output",help="write the JSON results to this file instead of stdout")
+    parser.add_argument("--repeat",type=int,default=3,help="timed runs per case (the median is reported)")
+    parser.add_argument("--evaluator",action="append",help="only run this evaluator (repeatable)")
+    parser.add_argument("--program",action="append",help="only run this program (repeatable)")
+    parser.add_argument("--list",action="store_true",help="list the cases and exit")
+    parser.add_argument("--compare",nargs=2,metavar=("OLD","NEW"),help="compare two JSON result files")
+    parser.add_argument("--threshold",type=float,default=1.25,help="slowdown factor reported by --compare")
+    parser.add_argument("--micro",action="append",choices=[ name for (name,bench) in MICRO ],
+                        help="run this micro-benchmark of final.py (repeatable)")
+    parser.add_argument("--case",nargs=2,metavar=("EVALUATOR","PROGRAM"),help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.case:
+        print json.dumps(run_case_deep(args.case[0],args.case[1],args.repeat))
+        return 0
+
+    if args.micro:
+        run_micro(args.micro)
+        return 0
+
+    if args.list:
+        for (evaluator_name,program_name) in cases(args.evaluator,args.program):
+            print evaluator_name, program_name
+        return 0
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            old = json.load(f)
+        with open(args.compare[1]) as f:
+            new = json.load(f)
+        regressions = compare(old,new,args.threshold)
+        for line in regressions:
+            print line
+        return 1 if regressions else 0
+
+    report = json.dumps(run_suite(args.evaluator,args.program,args.repeat),indent=2,sort_keys=True)
+    if args.output:
+        with open(args.output,"w") as f:
+            f.write(report + "\n")
+    else:
+        print report
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
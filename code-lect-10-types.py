@@ -269,33 +269,71 @@ class EFunction (Exp):
 # Values
 #
 
+# values use __slots__ instead of a __dict__, and the type of
+# integers, Booleans and none is a property of the class rather than an
+# object per value
+#
+# integers, Booleans and none are never mutated, so VBoolean and VNone
+# only ever create two and one instances, and VInteger shares the
+# instances of small integers
+
 class Value (object):
-    pass
+    __slots__ = ()
 
 
+SMALL_INT_MIN = -128
+SMALL_INT_MAX = 1024
+
 class VInteger (Value):
     # Value representation of integers
-    
-    def __init__ (self,i):
-        self.value = i
-        self.type = TInteger()
+    __slots__ = ("value",)
+
+    def __new__ (cls,i):
+        if SMALL_INT_MIN <= i < SMALL_INT_MAX:
+            return SMALL_INTS[i - SMALL_INT_MIN]
+        v = Value.__new__(cls)
+        v.value = i
+        return v
+
+    @property
+    def type (self):
+        return TInteger()
 
     def __str__ (self):
         return str(self.value)
 
+
+def _make_small_int (i):
+    v = Value.__new__(VInteger)
+    v.value = i
+    return v
+
+SMALL_INTS = [ _make_small_int(i) for i in range(SMALL_INT_MIN,SMALL_INT_MAX) ]
+
     
 class VBoolean (Value):
     # Value representation of Booleans
-    
-    def __init__ (self,b):
-        self.value = b
-        self.type = TBoolean()
+    __slots__ = ("value",)
+
+    def __new__ (cls,b):
+        return TRUE if b else FALSE
+
+    @property
+    def type (self):
+        return TBoolean()
 
     def __str__ (self):
         return "true" if self.value else "false"
 
+
+TRUE = Value.__new__(VBoolean)
+TRUE.value = True
+FALSE = Value.__new__(VBoolean)
+FALSE.value = False
+
     
 class VClosure (Value):
+    __slots__ = ("_params","_body","_env","type")
     
     def __init__ (self,params,body,env,name=None):
         self._params = params
@@ -310,6 +348,7 @@ class VClosure (Value):
 
     
 class VRefCell (Value):
+    __slots__ = ("content","type")
 
     def __init__ (self,initial):
         self.content = initial
@@ -320,14 +359,22 @@ class VRefCell (Value):
 
 
 class VNone (Value):
+    __slots__ = ()
 
-    def __init__ (self):
-        self.type = TNone()
+    def __new__ (cls):
+        return NONE
+
+    @property
+    def type (self):
+        return TNone()
 
     def __str__ (self):
         return "none"
 
 
+NONE = Value.__new__(VNone)
+
+
 
 
 # Primitive operations
@@ -9,7 +9,7 @@
 #
 # Type checking
 #
-# use shell() to start
+# use shell() to start, or Interpreter() to embed the language
 
 """
 Names:
@@ -47,8 +47,17 @@ Our test cases:
 """
 
 
+import cPickle
+import gc
+import hashlib
+import multiprocessing
+import os
 import sys
+import threading
+import time
 import traceback
+import weakref
+import zlib
 
 
 
@@ -56,7 +65,127 @@ import traceback
 # helper code to time the execution of a piece of code
 #
 
-typetable = []
+class Timer(object):
+    def __enter__(self):
+        self.__start = time.time()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        # Error handling here
+        self.__finish = time.time()
+
+    def duration_in_seconds(self):
+        return self.__finish - self.__start
+
+    def time (self):
+        return time.time() - self.__start
+
+
+############################################################
+# persistent maps for symbol tables
+#
+# a hash trie with 32-way branching: set() copies only the path down to
+# the changed entry and leaves the original map untouched, so extending
+# and looking up a symbol table are O(log n) instead of O(n)
+# a later set() of the same name shadows the earlier one, like appending
+# to an association list
+
+class _Leaf (object):
+    __slots__ = ("hash","key","value")
+
+    def __init__ (self,hash,key,value):
+        self.hash = hash
+        self.key = key
+        self.value = value
+
+
+class _Bucket (object):
+    # keys whose hashes are identical
+    __slots__ = ("hash","pairs")
+
+    def __init__ (self,hash,pairs):
+        self.hash = hash
+        self.pairs = pairs
+
+
+_EMPTY_NODE = (None,) * 32
+
+def _pmap_set (node,h,key,value,shift):
+    # returns the new node and the number of keys added (0 or 1)
+    i = (h >> shift) & 31
+    entry = node[i]
+    added = 1
+    if entry is None:
+        new = _Leaf(h,key,value)
+    elif entry.__class__ is tuple:
+        (new,added) = _pmap_set(entry,h,key,value,shift+5)
+    elif entry.__class__ is _Leaf and entry.key == key:
+        new = _Leaf(h,key,value)
+        added = 0
+    elif entry.hash == h:
+        pairs = ((entry.key,entry.value),) if entry.__class__ is _Leaf else entry.pairs
+        rest = tuple([ (k,v) for (k,v) in pairs if k != key ])
+        added = len(rest) - len(pairs) + 1
+        new = _Bucket(h,rest + ((key,value),))
+    else:
+        # push the existing entry one level down and try again there
+        j = (entry.hash >> (shift+5)) & 31
+        sub = _EMPTY_NODE[:j] + (entry,) + _EMPTY_NODE[j+1:]
+        (new,added) = _pmap_set(sub,h,key,value,shift+5)
+    return (node[:i] + (new,) + node[i+1:],added)
+
+
+class PMap (object):
+    __slots__ = ("_root","_size")
+
+    def __init__ (self,root=_EMPTY_NODE,size=0):
+        self._root = root
+        self._size = size
+
+    def get (self,key,default=None):
+        h = hash(key)
+        node = self._root
+        shift = 0
+        while True:
+            entry = node[(h >> shift) & 31]
+            if entry is None:
+                return default
+            if entry.__class__ is tuple:
+                node = entry
+                shift += 5
+            elif entry.__class__ is _Leaf:
+                return entry.value if entry.key == key else default
+            else:
+                for (k,v) in entry.pairs:
+                    if k == key:
+                        return v
+                return default
+
+    def set (self,key,value):
+        (root,added) = _pmap_set(self._root,hash(key),key,value,0)
+        return PMap(root,self._size + added)
+
+    def update (self,pairs):
+        # later pairs shadow earlier ones and the map itself
+        result = self
+        for (key,value) in pairs:
+            result = result.set(key,value)
+        return result
+
+    def update_missing (self,pairs):
+        # the bindings of the map shadow the pairs
+        # (like putting the pairs in front of an association list)
+        result = self
+        for (key,value) in reversed(pairs):
+            if key not in result:
+                result = result.set(key,value)
+        return result
+
+    def __contains__ (self,key):
+        return self.get(key,_Leaf) is not _Leaf
+
+    def __len__ (self):
+        return self._size
 
 
 #
@@ -64,12 +193,18 @@ typetable = []
 #
 
 class Exp (object):
-    pass
+
+    def __getstate__ (self):
+        # the caches of free_ids() and typecheck_cached() are not pickled
+        state = self.__dict__.copy()
+        state.pop("_free_ids",None)
+        state.pop("_type_cache",None)
+        return state
 
 
 # evaluation function -- all the evaluation code is here now
 
-def eval_iter (exp,env):
+def eval_iter (exp,env,tail=False):
     current_exp = exp
     current_env = env
     while True:
@@ -79,9 +214,13 @@ def eval_iter (exp,env):
 
             f = eval_iter(current_exp._fun,current_env)
             args = [ eval_iter(e,current_env) for e in current_exp._args]
+            if f._memo is not None and not tail:
+                return memo_call(f,args,apply_iter)
             new_env = f._env + zip(f._params,args)
             current_exp = f._body
             current_env = new_env
+            # calls from here on are tail calls
+            tail = True
 
         elif current_exp.expForm == "EIf":
 
@@ -91,6 +230,18 @@ def eval_iter (exp,env):
             else:
                 current_exp = current_exp._else
 
+        elif current_exp.expForm == "ESeq":
+
+            for e in current_exp._exps[:-1]:
+                eval_iter(e,current_env)
+            current_exp = current_exp._exps[-1]
+
+        elif current_exp.expForm == "EWhile":
+
+            while eval_iter(current_exp._cond,current_env).value:
+                eval_iter(current_exp._body,current_env)
+            return VNone()
+
         elif current_exp.expForm == "EValue":
 
             return current_exp._value
@@ -114,6 +265,1225 @@ def eval_iter (exp,env):
 
             raise Exception("Unrecognized expression form: {}".format(current_exp.expForm))
 
+def apply_iter (f,args):
+    # run the body of f; its tail calls skip the caches, since their
+    # result is the one memo_call() stores for this call
+    return eval_iter(f._body,f._env + zip(f._params,args),True)
+
+
+# call by need
+#
+# eval_need is eval_iter except at calls: an argument is bound to a
+# thunk that evaluates it in the environment of the call the first time
+# its parameter is looked up, and keeps the value for later lookups
+# arguments that cost nothing to evaluate (constants, identifiers and
+# functions) are bound directly, an identifier sharing the thunk it
+# may be bound to; so are pure primitives applied to values, which
+# are cheaper than a thunk and keep accumulating parameters from
+# growing chains of thunks as deep as the loop
+# an accumulating parameter that calls a function still grows such a
+# chain; force() walks it with an explicit stack, forcing first the
+# thunks a thunk is certain to force, directly or in the functions it
+# calls (see strict_thunks()), so that none of them nests in the
+# evaluation of the other
+#
+# primitives take values: EPrimCall evaluates its arguments, which
+# forces them, so the closures of initial_env() are strict
+# closures of engine need hold thunks, which eval_iter does not know:
+# pmap applies them with eval_need (see initial_need_env()), and
+# memoization is not available, since a cache needs the values of
+# the arguments
+
+class Thunk (object):
+    __slots__ = ("exp","env","value")
+
+    def __init__ (self,exp,env):
+        self.exp = exp
+        self.env = env
+        self.value = None
+
+    def force (self):
+        # a thunk is evaluated once the thunks it needs have values:
+        # the second time it is on top of the stack
+        if self.value is not None:
+            return self.value
+        stack = [self]
+        expanded = set()
+        while stack:
+            t = stack[-1]
+            if t.value is not None:
+                stack.pop()
+            elif id(t) in expanded:
+                t.value = eval_need(t.exp,t.env)
+                # the environment is no longer needed
+                t.exp = None
+                t.env = None
+                stack.pop()
+            else:
+                expanded.add(id(t))
+                stack.extend(strict_thunks(t.exp,t.env))
+        return self.value
+
+    def __getstate__ (self):
+        return (self.exp,self.env,self.value)
+
+    def __setstate__ (self,state):
+        (self.exp,self.env,self.value) = state
+
+# strict_thunks() looks into the bodies of the functions a thunk calls,
+# to find the thunks their parameters stand for, but only STRICT_DEPTH
+# calls deep and for STRICT_STEPS expressions at most: what it misses
+# is forced when evaluation gets there, nested in the thunk that does
+
+STRICT_DEPTH = 4
+STRICT_STEPS = 256
+
+def strict_thunks (exp,env,depth=0,steps=None):
+    # the thunks without a value that evaluating exp in env certainly
+    # forces: the ones the identifiers it certainly looks up stand for
+    # these are the arguments of primitives, the condition of a
+    # conditional and what both of its branches look up (or the one
+    # its condition picks, when that is known already), and the
+    # function of a call; when that function is known, also the
+    # arguments of the parameters its body certainly looks up
+    # the env of a body being looked into is (args,env), args mapping
+    # its parameters to their argument and the env of that argument
+    # steps counts the expressions looked at, branches included
+    if steps is None:
+        steps = [0]
+    thunks = []
+    seen = set()
+    todo = [(exp,env,depth)]
+    while todo and steps[0] < STRICT_STEPS:
+        (exp,env,depth) = todo.pop()
+        steps[0] += 1
+        form = exp.expForm
+        if form == "EId":
+            v = strict_lookup(exp._id,env)
+            if v.__class__ is tuple:
+                todo.append(v + (depth,))
+            elif v.__class__ is Thunk and v.value is None and id(v) not in seen:
+                seen.add(id(v))
+                thunks.append(v)
+        elif form == "EPrimCall":
+            todo.extend([ (e,env,depth) for e in exp._exps ])
+        elif form == "EIf":
+            todo.append((exp._cond,env,depth))
+            v = strict_value(exp._cond,env)
+            if v is not None:
+                # the branch is known already
+                todo.append((exp._then if v.value else exp._else,env,depth))
+                continue
+            others = set([ id(t) for t in strict_thunks(exp._else,env,depth,steps) ])
+            for t in strict_thunks(exp._then,env,depth,steps):
+                if id(t) in others and id(t) not in seen:
+                    seen.add(id(t))
+                    thunks.append(t)
+        elif form == "ESeq":
+            todo.append((exp._exps[0],env,depth))
+        elif form == "EWhile":
+            todo.append((exp._cond,env,depth))
+        elif form == "ECall":
+            todo.append((exp._fun,env,depth))
+            f = strict_callee(exp._fun,env)
+            if f is not None and depth < STRICT_DEPTH and len(f[0]) == len(exp._args):
+                (params,body,args,fenv) = f
+                args.update([ (p,(e,env)) for (p,e) in zip(params,exp._args) ])
+                todo.append((body,(args,fenv),depth+1))
+    return thunks
+
+def strict_lookup (name,env):
+    # what name stands for in an env of strict_thunks(): a value or
+    # thunk, an (exp,env) argument, or None for a function's own name
+    while env.__class__ is tuple:
+        (args,env) = env
+        if name in args:
+            return args[name]
+    for (id,v) in reversed(env):
+        if name == id:
+            return v
+    return None
+
+def strict_value (exp,env):
+    # cheap_value() in an env of strict_thunks()
+    form = exp.expForm
+    if form == "EValue":
+        return exp._value
+    if form == "EId":
+        v = strict_lookup(exp._id,env)
+        if v.__class__ is tuple:
+            return strict_value(*v)
+        return v.value if v.__class__ is Thunk else v
+    if form == "EPrimCall" and exp._prim in PURE_PRIMS:
+        vs = [ strict_value(e,env) for e in exp._exps ]
+        if None not in vs:
+            return apply(exp._prim,vs)
+    return None
+
+def strict_callee (exp,env):
+    # the function exp evaluates to in an env of strict_thunks(), as
+    # (params,body,args,env) for its body, or None if that is not known
+    while True:
+        if exp.expForm == "EFunction":
+            return (exp._params,exp._body,{exp._name:None} if exp._name else {},env)
+        if exp.expForm != "EId":
+            return None
+        v = strict_lookup(exp._id,env)
+        if v.__class__ is tuple:
+            (exp,env) = v
+            continue
+        if v.__class__ is Thunk:
+            v = v.value
+        if isinstance(v,VClosure) and v._frame is None:
+            return (v._params,v._body,{},v._env)
+        return None
+
+def delay (exp,env):
+    # what a parameter is bound to for the argument exp
+    if exp.expForm == "EValue":
+        return exp._value
+    if exp.expForm == "EId":
+        for (id,v) in reversed(env):
+            if exp._id == id:
+                return v
+    elif exp.expForm == "EFunction":
+        return VClosure(exp._params,exp._body,env,exp._name)
+    else:
+        v = cheap_value(exp,env)
+        if v is not None:
+            return v
+    return Thunk(exp,env)
+
+def cheap_value (exp,env):
+    # the value of exp if it only applies pure primitives to constants
+    # and to identifiers whose values are known, otherwise None
+    if exp.expForm == "EValue":
+        return exp._value
+    if exp.expForm == "EId":
+        for (id,v) in reversed(env):
+            if exp._id == id:
+                return v.value if v.__class__ is Thunk else v
+    elif exp.expForm == "EPrimCall" and exp._prim in PURE_PRIMS:
+        vs = [ cheap_value(e,env) for e in exp._exps ]
+        if None not in vs:
+            return apply(exp._prim,vs)
+    return None
+
+def eval_need (exp,env):
+    current_exp = exp
+    current_env = env
+    while True:
+        if current_exp.expForm == "ECall":
+
+            f = eval_need(current_exp._fun,current_env)
+            args = [ delay(e,current_env) for e in current_exp._args]
+            current_env = f._env + zip(f._params,args)
+            current_exp = f._body
+
+        elif current_exp.expForm == "EIf":
+
+            v = eval_need(current_exp._cond,current_env)
+            if v.value:
+                current_exp = current_exp._then
+            else:
+                current_exp = current_exp._else
+
+        elif current_exp.expForm == "ESeq":
+
+            for e in current_exp._exps[:-1]:
+                eval_need(e,current_env)
+            current_exp = current_exp._exps[-1]
+
+        elif current_exp.expForm == "EWhile":
+
+            while eval_need(current_exp._cond,current_env).value:
+                eval_need(current_exp._body,current_env)
+            return VNone()
+
+        elif current_exp.expForm == "EValue":
+
+            return current_exp._value
+
+        elif current_exp.expForm == "EPrimCall":
+
+            vs = [ eval_need(e,current_env) for e in current_exp._exps ]
+            return apply(current_exp._prim,vs)
+
+        elif current_exp.expForm == "EId":
+
+            for (id,v) in reversed(current_env):
+                if current_exp._id == id:
+                    return v.force() if v.__class__ is Thunk else v
+
+        elif current_exp.expForm == "EFunction":
+
+            return VClosure(current_exp._params,current_exp._body,current_env,current_exp._name)
+
+        else:
+
+            raise Exception("Unrecognized expression form: {}".format(current_exp.expForm))
+
+
+# profiling eval_iter
+#
+# eval_iter_profiled is eval_iter plus counters: visits and time per
+# expression form, the length of every identifier lookup in the
+# environment, the bindings copied into new environments at calls,
+# the closures allocated and the calls of each primitive
+# the counters live in an EvalProfile that every call passes down, so
+# each Interpreter profiles its own evaluations, and eval_iter itself
+# does not pay anything when profiling is off
+#
+# times are self times: the nested evaluation of a subexpression
+# is charged to the form of that subexpression
+
+class EvalProfile (object):
+
+    def __init__ (self):
+        self.enabled = False
+        self.reset()
+
+    def reset (self):
+        self.visits = {}
+        self.times = {}
+        self.lookups = {}      # length of the lookup -> number of lookups
+        self.copied = 0        # bindings copied into call environments
+        self.closures = 0
+        self.prims = {}
+        self.nested = 0.0      # time spent in nested evaluations so far
+
+    def report (self):
+        lines = ["{:<12}{:>10}{:>12}{:>8}".format("form","visits","time","%")]
+        total = sum(self.times.values())
+        for form in sorted(self.visits,key=lambda form: -self.times.get(form,0.0)):
+            t = self.times.get(form,0.0)
+            lines.append("{:<12}{:>10}{:>11.4f}s{:>7.1f}%".format(form,self.visits[form],t,
+                                                             100.0*t/total if total else 0.0))
+        lookups = sum(self.lookups.values())
+        if lookups:
+            steps = sum([ length*count for (length,count) in self.lookups.items() ])
+            lines.append("lookups: {}, average length {:.1f}, longest {}".format(
+                lookups,float(steps)/lookups,max(self.lookups)))
+        calls = self.visits.get("ECall",0)
+        if calls:
+            lines.append("bindings copied at calls: {}, average {:.1f}".format(
+                self.copied,float(self.copied)/calls))
+        lines.append("closures allocated: {}".format(self.closures))
+        if self.prims:
+            lines.append("primitives: {}".format(", ".join([ "{} {}".format(name,count)
+                                                            for (name,count) in sorted(self.prims.items()) ])))
+        return "\n".join(lines)
+
+    def apply (self,f,args):
+        # apply_iter(), profiled
+        return eval_iter_profiled(f._body,f._env + zip(f._params,args),self,True)
+
+def eval_iter_profiled (exp,env,prof,tail=False):
+    # the caller sees the whole time of this call as nested time,
+    # including what the calls nested in this one already added
+    nested = prof.nested
+    start = time.time()
+    try:
+        return _eval_iter_profiled(exp,env,prof,tail)
+    finally:
+        prof.nested = nested + (time.time() - start)
+
+def _eval_iter_profiled (exp,env,prof,tail=False):
+    current_exp = exp
+    current_env = env
+    while True:
+        form = current_exp.expForm
+        prof.visits[form] = prof.visits.get(form,0) + 1
+        start = time.time()
+        nested = prof.nested
+        value = None
+
+        if form == "ECall":
+
+            f = eval_iter_profiled(current_exp._fun,current_env,prof)
+            args = [ eval_iter_profiled(e,current_env,prof) for e in current_exp._args]
+            if f._memo is not None and not tail:
+                value = memo_call(f,args,prof.apply)
+                prof.times[form] = prof.times.get(form,0.0) + (time.time() - start) - (prof.nested - nested)
+                return value
+            new_env = f._env + zip(f._params,args)
+            prof.copied += len(new_env)
+            current_exp = f._body
+            current_env = new_env
+            tail = True
+
+        elif form == "EIf":
+
+            v = eval_iter_profiled(current_exp._cond,current_env,prof)
+            if v.value:
+                current_exp = current_exp._then
+            else:
+                current_exp = current_exp._else
+
+        elif form == "ESeq":
+
+            for e in current_exp._exps[:-1]:
+                eval_iter_profiled(e,current_env,prof)
+            current_exp = current_exp._exps[-1]
+
+        elif form == "EWhile":
+
+            while eval_iter_profiled(current_exp._cond,current_env,prof).value:
+                eval_iter_profiled(current_exp._body,current_env,prof)
+            value = VNone()
+
+        elif form == "EValue":
+
+            value = current_exp._value
+
+        elif form == "EPrimCall":
+
+            vs = [ eval_iter_profiled(e,current_env,prof) for e in current_exp._exps ]
+            name = current_exp._prim.__name__
+            prof.prims[name] = prof.prims.get(name,0) + 1
+            value = apply(current_exp._prim,vs)
+
+        elif form == "EId":
+
+            length = 0
+            for (id,v) in reversed(current_env):
+                length += 1
+                if current_exp._id == id:
+                    value = v
+                    break
+            prof.lookups[length] = prof.lookups.get(length,0) + 1
+
+        elif form == "EFunction":
+
+            prof.closures += 1
+            value = VClosure(current_exp._params,current_exp._body,current_env,current_exp._name)
+
+        else:
+
+            raise Exception("Unrecognized expression form: {}".format(current_exp.expForm))
+
+        prof.times[form] = prof.times.get(form,0.0) + (time.time() - start) - (prof.nested - nested)
+        if value is not None:
+            return value
+
+
+# evaluation function with an explicit continuation stack
+# eval_iter recurses in Python for the function position, the arguments
+# and the conditions; here every pending computation is pushed on konts
+# instead, so the depth of guest recursion is only limited by memory
+#
+# a continuation is a list [kind,exp,env,values...]
+
+K_IF = 0        # waiting for the condition of exp
+K_CALL = 1      # waiting for the function and arguments of exp
+K_PRIM = 2      # waiting for the arguments of exp
+K_MEMO = 3      # [K_MEMO,closure,key]: waiting for a result to cache
+K_SEQ = 4       # [K_SEQ,exp,env,i]: waiting for the statement before exps[i]
+K_WHILE = 5     # [K_WHILE,exp,env,in_body]: waiting for the condition or the body
+
+def eval_cont (exp,env,stats=None):
+    current_exp = exp
+    current_env = env
+    konts = []
+    max_depth = 0
+    while True:
+        # evaluate current_exp until we either get a value
+        # or push a continuation and move on to a subexpression
+        form = current_exp.expForm
+        if form == "ECall":
+            konts.append([K_CALL,current_exp,current_env])
+            if len(konts) > max_depth:
+                max_depth = len(konts)
+            current_exp = current_exp._fun
+            continue
+
+        elif form == "EIf":
+            konts.append([K_IF,current_exp,current_env])
+            if len(konts) > max_depth:
+                max_depth = len(konts)
+            current_exp = current_exp._cond
+            continue
+
+        elif form == "ESeq":
+            if len(current_exp._exps) > 1:
+                konts.append([K_SEQ,current_exp,current_env,1])
+                if len(konts) > max_depth:
+                    max_depth = len(konts)
+            current_exp = current_exp._exps[0]
+            continue
+
+        elif form == "EWhile":
+            # the same continuation serves every iteration
+            konts.append([K_WHILE,current_exp,current_env,False])
+            if len(konts) > max_depth:
+                max_depth = len(konts)
+            current_exp = current_exp._cond
+            continue
+
+        elif form == "EValue":
+            value = current_exp._value
+
+        elif form == "EPrimCall":
+            if current_exp._exps:
+                konts.append([K_PRIM,current_exp,current_env])
+                if len(konts) > max_depth:
+                    max_depth = len(konts)
+                current_exp = current_exp._exps[0]
+                continue
+            value = current_exp._prim()
+
+        elif form == "EId":
+            for (id,v) in reversed(current_env):
+                if current_exp._id == id:
+                    value = v
+                    break
+            else:
+                raise Exception("Runtime error: unbound identifier {}".format(current_exp._id))
+
+        elif form == "EFunction":
+            value = VClosure(current_exp._params,current_exp._body,current_env,current_exp._name)
+
+        else:
+            raise Exception("Unrecognized expression form: {}".format(form))
+
+        # pass value to the pending continuations until one of them
+        # has another expression to evaluate
+        while True:
+            if not konts:
+                if stats is not None:
+                    stats["max_depth"] = max_depth
+                return value
+            k = konts[-1]
+            if k[0] == K_CALL:
+                k.append(value)
+                done = len(k) - 3
+                args = k[1]._args
+                if done <= len(args):
+                    current_exp = args[done-1]
+                    current_env = k[2]
+                    break
+                # the call is complete: the body runs with the
+                # continuation of the call, so tail calls do not grow konts
+                konts.pop()
+                f = k[3]
+                if f._memo is not None:
+                    key = memo_key(k[4:])
+                    if key is not None:
+                        cached = f._memo.get(key,MEMO_MISS)
+                        if cached is not MEMO_MISS:
+                            value = cached
+                            continue
+                        # the result goes into the cache on its way back
+                        konts.append([K_MEMO,f,key])
+                        if len(konts) > max_depth:
+                            max_depth = len(konts)
+                current_exp = f._body
+                current_env = f._env + zip(f._params,k[4:])
+                break
+            elif k[0] == K_MEMO:
+                konts.pop()
+                k[1]._memo.put(k[2],value)
+            elif k[0] == K_IF:
+                konts.pop()
+                current_exp = k[1]._then if value.value else k[1]._else
+                current_env = k[2]
+                break
+            elif k[0] == K_SEQ:
+                exps = k[1]._exps
+                i = k[3]
+                if i == len(exps) - 1:
+                    # the last expression runs with the continuation of the sequence
+                    konts.pop()
+                else:
+                    k[3] = i + 1
+                current_exp = exps[i]
+                current_env = k[2]
+                break
+            elif k[0] == K_WHILE:
+                if k[3]:
+                    k[3] = False
+                    current_exp = k[1]._cond
+                elif value.value:
+                    k[3] = True
+                    current_exp = k[1]._body
+                else:
+                    konts.pop()
+                    value = VNone()
+                    continue
+                current_env = k[2]
+                break
+            else:
+                k.append(value)
+                done = len(k) - 3
+                exps = k[1]._exps
+                if done < len(exps):
+                    current_exp = exps[done]
+                    current_env = k[2]
+                    break
+                konts.pop()
+                value = apply(k[1]._prim,k[3:])
+
+
+# evaluation function over resolved expressions (see resolve() below)
+# identifiers have been turned into (depth,slot) addresses, so lookups
+# and calls do not depend on how big the environment is
+
+def eval_frame (exp,frame,tail=False):
+    current_exp = exp
+    current_frame = frame
+    while True:
+        if current_exp.expForm == "ECall":
+
+            f = eval_frame(current_exp._fun,current_frame)
+            args = [ eval_frame(e,current_frame) for e in current_exp._args]
+            if f._memo is not None and not tail:
+                return memo_call(f,args,apply_frame)
+            if f._name:
+                # slot 0 of a recursive function's frame is the function itself
+                args.insert(0,f)
+            current_exp = f._body
+            current_frame = Frame(args,f._frame)
+            tail = True
+
+        elif current_exp.expForm == "EIf":
+
+            v = eval_frame(current_exp._cond,current_frame)
+            if v.value:
+                current_exp = current_exp._then
+            else:
+                current_exp = current_exp._else
+
+        elif current_exp.expForm == "ESeq":
+
+            for e in current_exp._exps[:-1]:
+                eval_frame(e,current_frame)
+            current_exp = current_exp._exps[-1]
+
+        elif current_exp.expForm == "EWhile":
+
+            while eval_frame(current_exp._cond,current_frame).value:
+                eval_frame(current_exp._body,current_frame)
+            return VNone()
+
+        elif current_exp.expForm == "EValue":
+
+            return current_exp._value
+
+        elif current_exp.expForm == "EPrimCall":
+
+            vs = [ eval_frame(e,current_frame) for e in current_exp._exps ]
+            return apply(current_exp._prim,vs)
+
+        elif current_exp.expForm == "ELocal":
+
+            fr = current_frame
+            for i in xrange(current_exp._depth):
+                fr = fr.parent
+            return fr.slots[current_exp._slot]
+
+        elif current_exp.expForm == "EFunction":
+
+            return VClosure(current_exp._params,current_exp._body,[],current_exp._name,frame=current_frame)
+
+        else:
+
+            raise Exception("Unrecognized expression form: {}".format(current_exp.expForm))
+
+def apply_frame (f,args):
+    return eval_frame(f._body,Frame([f] + args if f._name else args,f._frame),True)
+
+
+# closure compilation of resolved expressions
+# each expression is inspected once and turned into a Python function
+# taking a Frame; calls in tail position return a TailCall that the
+# nearest enclosing non-tail call runs, so tail recursion stays iterative
+
+class TailCall (object):
+    __slots__ = ("fun","args")
+
+    def __init__ (self,fun,args):
+        self.fun = fun
+        self.args = args
+
+
+def call_closure (f,args,memo=True):
+    # memo is False for the call memo_call() makes, so that f and
+    # its tail calls run without the caches
+    if memo and f._memo is not None and f._raw is None:
+        return memo_call(f,args,apply_closure)
+    while True:
+        if f._code is None:
+            f._code = compile_exp(f._body,True)
+        if f._name:
+            args.insert(0,f)
+        r = f._code(Frame(args,f._frame))
+        if r.__class__ is not TailCall:
+            return r
+        f = r.fun
+        args = r.args
+
+def apply_closure (f,args):
+    return call_closure(f,args,False)
+
+
+def compile_exp (exp,tail=False):
+    form = exp.expForm
+
+    if form == "EValue":
+        v = exp._value
+        return lambda frame: v
+
+    elif form == "ELocal":
+        depth = exp._depth
+        slot = exp._slot
+        if depth == 0:
+            return lambda frame: frame.slots[slot]
+        elif depth == 1:
+            return lambda frame: frame.parent.slots[slot]
+        elif depth == 2:
+            return lambda frame: frame.parent.parent.slots[slot]
+        def lookup (frame):
+            for i in xrange(depth):
+                frame = frame.parent
+            return frame.slots[slot]
+        return lookup
+
+    elif form == "EIf":
+        c = compile_exp(exp._cond)
+        t = compile_exp(exp._then,tail)
+        e = compile_exp(exp._else,tail)
+        return lambda frame: t(frame) if c(frame).value else e(frame)
+
+    elif form == "ESeq":
+        cs = [ compile_exp(e) for e in exp._exps[:-1] ]
+        last = compile_exp(exp._exps[-1],tail)
+        def seq (frame):
+            for c in cs:
+                c(frame)
+            return last(frame)
+        return seq
+
+    elif form == "EWhile":
+        c = compile_exp(exp._cond)
+        b = compile_exp(exp._body)
+        def loop (frame):
+            while c(frame).value:
+                b(frame)
+            return NONE
+        return loop
+
+    elif form == "EPrimCall":
+        prim = exp._prim
+        cs = [ compile_exp(e) for e in exp._exps ]
+        if len(cs) == 1:
+            c0 = cs[0]
+            return lambda frame: prim(c0(frame))
+        elif len(cs) == 2:
+            c0 = cs[0]
+            c1 = cs[1]
+            return lambda frame: prim(c0(frame),c1(frame))
+        return lambda frame: prim(*[ c(frame) for c in cs ])
+
+    elif form == "ECall":
+        cf = compile_exp(exp._fun)
+        cs = [ compile_exp(e) for e in exp._args ]
+        if tail:
+            return lambda frame: TailCall(cf(frame),[ c(frame) for c in cs ])
+        return lambda frame: call_closure(cf(frame),[ c(frame) for c in cs ])
+
+    elif form == "EFunction":
+        params = exp._params
+        body = exp._body
+        name = exp._name
+        code = compile_exp(body,True)
+        return lambda frame: VClosure(params,body,[],name,frame=frame,code=code)
+
+    raise Exception("Cannot compile expression form: {}".format(form))
+
+
+def eval_compiled (exp,frame):
+    # compile and run a resolved expression
+    return compile_exp(exp)(frame)
+
+
+# unboxed compilation of resolved expressions
+# like compile_exp, but values the types say are int or bool stay raw
+# Python ints and bools; they are boxed into VInteger and VBoolean only
+# where a Value is needed: arguments and results of functions whose
+# types are not int or bool (generic ones in particular), reference
+# cells, and the primitives that work on Values
+#
+# every compiled expression has a kind, "int", "bool" or "box" (a Value)
+# kinds lists the kinds of the slots of each enclosing frame, innermost
+# first, and fns the (parameter kinds, result kind) of the function
+# owning each of these frames if it is named (it sits in slot 0);
+# the frame after the last one in kinds is the global frame glob,
+# whose slots hold Values that can be looked at while compiling
+#
+# a closure compiled this way has _raw = (parameter kinds, result kind,
+# code, kinds of the frames it captured), which compiled calls use
+# directly; its _code unboxes the arguments and boxes the result, so
+# call_closure() works on it too
+# pickling keeps neither, so a pickled closure gets a copy of the frames
+# it captured with their raw slots boxed (see boxed_frames())
+
+def type_kind (t):
+    if t is not None and t.isInteger():
+        return "int"
+    if t is not None and t.isBoolean():
+        return "bool"
+    return "box"
+
+def convert (c,kind,want):
+    # code c produces kind, make it produce want
+    if kind == want:
+        return c
+    if want == "box":
+        if kind == "int":
+            return lambda frame: VInteger(c(frame))
+        return lambda frame: VBoolean(c(frame))
+    if kind == "box":
+        return lambda frame: c(frame).value
+    return c
+
+def box (v,kind):
+    if kind == "int":
+        return VInteger(v)
+    if kind == "bool":
+        return VBoolean(v)
+    return v
+
+def call_raw (f,args,memo=True):
+    # call a closure with a raw entry, arguments of its parameter kinds
+    if memo and f._memo is not None:
+        return memo_call(f,args,apply_raw)
+    while True:
+        code = f._raw[2]
+        if f._name:
+            args.insert(0,f)
+        r = code(Frame(args,f._frame))
+        if r.__class__ is not TailCall:
+            return r
+        f = r.fun
+        args = r.args
+
+def apply_raw (f,args):
+    return call_raw(f,args,False)
+
+def call_value (f,args):
+    # call any closure on Values, getting a Value back
+    if f._raw is None:
+        return call_closure(f,args)
+    (kinds,result,code,fkinds) = f._raw
+    args = [ a if k == "box" else a.value for (k,a) in zip(kinds,args) ]
+    return box(call_raw(f,args),result)
+
+def make_raw_closure (params,body,name,frame,kinds,result,code,fkinds=()):
+    # fkinds are the kinds of the slots of frame and its parents,
+    # as far as they are not the global frame
+    f = VClosure(params,body,[],name,frame=frame)
+    f._raw = (kinds,result,code,fkinds)
+    if name:
+        f._code = lambda frame: call_value(f,frame.slots[1:])
+    else:
+        f._code = lambda frame: call_value(f,frame.slots)
+    return f
+
+def compile_raw_function (exp,kinds,fns,glob,pkinds,result):
+    # code for the body of a function, as a frame of kinds pkinds
+    sig = (pkinds,result)
+    slots = ["box"] + pkinds if exp._name else pkinds
+    return compile_raw(exp._body,[slots] + kinds,[sig if exp._name else None] + fns,glob,result)[0]
+
+def compile_as (exp,kinds,fns,glob,want):
+    (c,kind) = compile_raw(exp,kinds,fns,glob)
+    return convert(c,kind,want)
+
+def compile_raw (exp,kinds,fns,glob,tail=None):
+    # returns code and its kind; in tail position, tail is the kind of
+    # the result of the function, and the code may return a TailCall
+    # to a function with a raw entry and the same result kind
+    form = exp.expForm
+
+    if form == "EValue":
+        v = exp._value
+        if isinstance(v,VBoolean):
+            (c,kind) = (lambda frame: v.value,"bool")
+        elif isinstance(v,VInteger):
+            (c,kind) = (lambda frame: v.value,"int")
+        else:
+            (c,kind) = (lambda frame: v,"box")
+
+    elif form == "ELocal":
+        depth = exp._depth
+        kind = kinds[depth][exp._slot] if depth < len(kinds) else "box"
+        c = compile_exp(exp)
+
+    elif form == "EIf":
+        cc = compile_as(exp._cond,kinds,fns,glob,"bool")
+        if tail:
+            t = compile_raw(exp._then,kinds,fns,glob,tail)[0]
+            e = compile_raw(exp._else,kinds,fns,glob,tail)[0]
+            kind = tail
+        else:
+            (t,tkind) = compile_raw(exp._then,kinds,fns,glob)
+            (e,ekind) = compile_raw(exp._else,kinds,fns,glob)
+            kind = tkind if tkind == ekind else "box"
+            t = convert(t,tkind,kind)
+            e = convert(e,ekind,kind)
+        return (lambda frame: t(frame) if cc(frame) else e(frame),kind)
+
+    elif form == "ESeq":
+        # the statements are of type none, so their kind does not matter
+        cs = [ compile_raw(e,kinds,fns,glob)[0] for e in exp._exps[:-1] ]
+        (last,kind) = compile_raw(exp._exps[-1],kinds,fns,glob,tail)
+        def seq (frame):
+            for c in cs:
+                c(frame)
+            return last(frame)
+        return (seq,kind)
+
+    elif form == "EWhile":
+        cc = compile_as(exp._cond,kinds,fns,glob,"bool")
+        cb = compile_raw(exp._body,kinds,fns,glob)[0]
+        def loop (frame):
+            while cc(frame):
+                cb(frame)
+            return NONE
+        (c,kind) = (loop,"box")
+
+    elif form == "EPrimCall":
+        prim = exp._prim
+        if prim in (oper_plus,oper_minus,oper_times):
+            c0 = compile_as(exp._exps[0],kinds,fns,glob,"int")
+            c1 = compile_as(exp._exps[1],kinds,fns,glob,"int")
+            if prim is oper_plus:
+                c = lambda frame: c0(frame) + c1(frame)
+            elif prim is oper_minus:
+                c = lambda frame: c0(frame) - c1(frame)
+            else:
+                c = lambda frame: c0(frame) * c1(frame)
+            kind = "int"
+        elif prim is oper_zero:
+            c0 = compile_as(exp._exps[0],kinds,fns,glob,"int")
+            (c,kind) = (lambda frame: c0(frame) == 0,"bool")
+        elif prim is oper_deref:
+            # reference cells only hold integers
+            c0 = compile_as(exp._exps[0],kinds,fns,glob,"box")
+            (c,kind) = (lambda frame: c0(frame).content.value,"int")
+        else:
+            cs = [ compile_as(e,kinds,fns,glob,"box") for e in exp._exps ]
+            (c,kind) = (lambda frame: prim(*[ c(frame) for c in cs ]),"box")
+
+    elif form == "ECall":
+        fun = exp._fun
+        sig = None
+        if fun.expForm == "ELocal":
+            if fun._depth < len(kinds):
+                if fun._slot == 0 and fns[fun._depth] is not None:
+                    # the enclosing named function itself
+                    sig = fns[fun._depth]
+                    cf = compile_exp(fun)
+            elif glob is not None:
+                f = glob.slots[fun._slot]
+                if isinstance(f,VClosure) and f._raw is not None:
+                    # global bindings never change, so call f directly
+                    sig = f._raw[:2]
+                    cf = lambda frame: f
+        if sig is not None and len(sig[0]) == len(exp._args):
+            cs = [ compile_as(e,kinds,fns,glob,k) for (e,k) in zip(exp._args,sig[0]) ]
+            kind = sig[1]
+            if tail == kind:
+                return (lambda frame: TailCall(cf(frame),[ c(frame) for c in cs ]),kind)
+            (c,kind) = (lambda frame: call_raw(cf(frame),[ c(frame) for c in cs ]),kind)
+        else:
+            cf = compile_as(fun,kinds,fns,glob,"box")
+            cs = [ compile_as(e,kinds,fns,glob,"box") for e in exp._args ]
+            (c,kind) = (lambda frame: call_value(cf(frame),[ c(frame) for c in cs ]),"box")
+
+    elif form == "EFunction":
+        # no types for inner functions: Values in, Value out
+        params = exp._params
+        body = exp._body
+        name = exp._name
+        pkinds = [ "box" for p in params ]
+        code = compile_raw_function(exp,kinds,fns,glob,pkinds,"box")
+        (c,kind) = (lambda frame: make_raw_closure(params,body,name,frame,pkinds,"box",code,kinds),"box")
+
+    else:
+        raise Exception("Cannot compile expression form: {}".format(form))
+
+    if tail:
+        return (convert(c,kind,tail),tail)
+    return (c,kind)
+
+def boxed_frames (frame,kinds):
+    # a copy of frame and of the parents kinds covers, with their raw
+    # slots boxed; the frames beyond are shared
+    if not kinds:
+        return frame
+    return Frame([ box(v,k) for (v,k) in zip(frame.slots,kinds[0]) ],boxed_frames(frame.parent,kinds[1:]))
+
+def eval_unboxed (exp,frame,typ=None):
+    # compile and run a resolved top-level expression
+    # typ is its type: a top-level function of known type gets raw
+    # parameters and result where the type says int or bool
+    if exp.expForm == "EFunction" and typ is not None and typ.isFunction() and len(typ.params) == len(exp._params):
+        pkinds = [ type_kind(t) for t in typ.params ]
+        result = type_kind(typ.result)
+        code = compile_raw_function(exp,[],[],frame,pkinds,result)
+        return make_raw_closure(exp._params,exp._body,exp._name,frame,pkinds,result,code)
+    return compile_as(exp,[],[],frame,"box")(frame)
+
+
+# bytecode compilation of resolved expressions
+# code is a flat list of integers: an opcode followed by its arguments
+# the VM keeps an explicit value stack and call stack, so it never
+# recurses in Python
+
+LOAD_CONST = 0      # const index
+LOAD_LOCAL = 1      # slot
+LOAD_OUTER = 2      # depth slot
+CALL = 3            # number of arguments
+TAILCALL = 4        # number of arguments
+JUMP_IF_FALSE = 5   # target
+JUMP = 6            # target
+MAKE_CLOSURE = 7    # const index of a CodeObject
+PRIM = 8            # const index of a primitive, number of arguments
+RETURN = 9
+POP = 10
+
+OPNAMES = ["LOAD_CONST","LOAD_LOCAL","LOAD_OUTER","CALL","TAILCALL",
+           "JUMP_IF_FALSE","JUMP","MAKE_CLOSURE","PRIM","RETURN","POP"]
+
+
+class CodeObject (object):
+
+    def __init__ (self,params,body,name=None):
+        self.params = params
+        self.body = body
+        self.name = name
+        self.code = []
+        self.consts = []
+        # pc -> identifier, for the disassembler
+        self.comments = {}
+
+    def add_const (self,v):
+        for (i,c) in enumerate(self.consts):
+            if c is v:
+                return i
+        self.consts.append(v)
+        return len(self.consts) - 1
+
+    def emit (self,exp,tail):
+        form = exp.expForm
+        code = self.code
+
+        if form == "EValue":
+            code.extend([LOAD_CONST,self.add_const(exp._value)])
+
+        elif form == "ELocal":
+            self.comments[len(code)] = exp._id
+            if exp._depth == 0:
+                code.extend([LOAD_LOCAL,exp._slot])
+            else:
+                code.extend([LOAD_OUTER,exp._depth,exp._slot])
+
+        elif form == "EIf":
+            self.emit(exp._cond,False)
+            code.extend([JUMP_IF_FALSE,None])
+            jump_else = len(code) - 1
+            self.emit(exp._then,tail)
+            if tail:
+                # both branches return, nothing to join
+                code[jump_else] = len(code)
+                self.emit(exp._else,tail)
+                return
+            code.extend([JUMP,None])
+            jump_end = len(code) - 1
+            code[jump_else] = len(code)
+            self.emit(exp._else,tail)
+            code[jump_end] = len(code)
+
+        elif form == "ESeq":
+            for e in exp._exps[:-1]:
+                self.emit(e,False)
+                code.append(POP)
+            self.emit(exp._exps[-1],tail)
+            return
+
+        elif form == "EWhile":
+            start = len(code)
+            self.emit(exp._cond,False)
+            code.extend([JUMP_IF_FALSE,None])
+            jump_end = len(code) - 1
+            self.emit(exp._body,False)
+            code.extend([POP,JUMP,start])
+            code[jump_end] = len(code)
+            code.extend([LOAD_CONST,self.add_const(NONE)])
+
+        elif form == "EPrimCall":
+            for e in exp._exps:
+                self.emit(e,False)
+            self.comments[len(code)] = exp._prim.__name__
+            code.extend([PRIM,self.add_const(exp._prim),len(exp._exps)])
+
+        elif form == "ECall":
+            self.emit(exp._fun,False)
+            for e in exp._args:
+                self.emit(e,False)
+            if tail:
+                code.extend([TAILCALL,len(exp._args)])
+                return
+            code.extend([CALL,len(exp._args)])
+
+        elif form == "EFunction":
+            co = compile_bytecode(exp._body,exp._params,exp._name)
+            self.comments[len(code)] = exp._name or "<function>"
+            code.extend([MAKE_CLOSURE,self.add_const(co)])
+
+        else:
+            raise Exception("Cannot compile expression form: {}".format(form))
+
+        if tail:
+            code.append(RETURN)
+
+
+def compile_bytecode (exp,params=[],name=None):
+    # compile a resolved expression as the body of a function
+    co = CodeObject(params,exp,name)
+    co.emit(exp,True)
+    return co
+
+
+def closure_bytecode (f):
+    if f._bytecode is None:
+        f._bytecode = compile_bytecode(f._body,f._params,f._name)
+    return f._bytecode
+
+
+def disassemble (co):
+    lines = ["code for {}({}):".format(co.name or "<function>",",".join(co.params))]
+    nested = []
+    code = co.code
+    pc = 0
+    while pc < len(code):
+        op = code[pc]
+        size = 1
+        if op in (LOAD_CONST,LOAD_LOCAL,CALL,TAILCALL,JUMP_IF_FALSE,JUMP,MAKE_CLOSURE):
+            size = 2
+        elif op in (LOAD_OUTER,PRIM):
+            size = 3
+        args = code[pc+1:pc+size]
+        line = "{:>5} {:<14}{}".format(pc,OPNAMES[op]," ".join([ str(a) for a in args ]))
+        if op == LOAD_CONST:
+            line += " ({})".format(co.consts[args[0]])
+        elif pc in co.comments:
+            line += " ({})".format(co.comments[pc])
+        if op == MAKE_CLOSURE:
+            nested.append(co.consts[args[0]])
+        lines.append(line)
+        pc += size
+    for c in nested:
+        lines.append("")
+        lines.append(disassemble(c))
+    return "\n".join(lines)
+
+
+def run_vm (co,frame,memo=True):
+    # memo is False when memo_call() runs a memoized function: the
+    # tail calls in that run skip the caches, their result is its result
+    stack = []
+    calls = []
+    code = co.code
+    consts = co.consts
+    pc = 0
+    while True:
+        op = code[pc]
+
+        if op == LOAD_LOCAL:
+            stack.append(frame.slots[code[pc+1]])
+            pc += 2
+
+        elif op == LOAD_OUTER:
+            fr = frame
+            for i in xrange(code[pc+1]):
+                fr = fr.parent
+            stack.append(fr.slots[code[pc+2]])
+            pc += 3
+
+        elif op == LOAD_CONST:
+            stack.append(consts[code[pc+1]])
+            pc += 2
+
+        elif op == PRIM:
+            n = code[pc+2]
+            args = stack[len(stack)-n:]
+            del stack[len(stack)-n:]
+            stack.append(consts[code[pc+1]](*args))
+            pc += 3
+
+        elif op == CALL or op == TAILCALL:
+            n = code[pc+1]
+            args = stack[len(stack)-n:]
+            del stack[len(stack)-n:]
+            f = stack.pop()
+            if f._memo is not None and (op == CALL or (memo and not calls)):
+                # a memoized call runs to completion in a nested loop
+                v = memo_call(f,args,apply_vm)
+                if op == TAILCALL:
+                    return v
+                stack.append(v)
+                pc += 2
+                continue
+            if op == CALL:
+                calls.append((co,pc+2,frame))
+            co = f._bytecode or closure_bytecode(f)
+            if f._name:
+                args.insert(0,f)
+            frame = Frame(args,f._frame)
+            code = co.code
+            consts = co.consts
+            pc = 0
+
+        elif op == JUMP_IF_FALSE:
+            if stack.pop().value:
+                pc += 2
+            else:
+                pc = code[pc+1]
+
+        elif op == JUMP:
+            pc = code[pc+1]
+
+        elif op == POP:
+            stack.pop()
+            pc += 1
+
+        elif op == RETURN:
+            if not calls:
+                return stack.pop()
+            (co,pc,frame) = calls.pop()
+            code = co.code
+            consts = co.consts
+
+        elif op == MAKE_CLOSURE:
+            c = consts[code[pc+1]]
+            stack.append(VClosure(c.params,c.body,[],c.name,frame=frame,bytecode=c))
+            pc += 2
+
+        else:
+            raise Exception("Unrecognized opcode: {}".format(op))
+
+
+def apply_vm (f,args):
+    co = f._bytecode or closure_bytecode(f)
+    return run_vm(co,Frame([f] + args if f._name else args,f._frame),False)
+
+
+def eval_vm (exp,frame):
+    # compile and run a resolved expression
+    return run_vm(compile_bytecode(exp),frame)
+
 
     
 class EValue (Exp):
@@ -123,7 +1493,7 @@ class EValue (Exp):
         self.expForm = "EValue"
         self.is_basic = True
 
-    def typecheck (self,symtable):
+    def typecheck (self,symtable,ctx):
         # type is the type of the literal 
         return self._value.type
     
@@ -133,6 +1503,15 @@ class EValue (Exp):
     def eval (self,env):
         return eval_iter(self,env)
 
+    def resolve (self,scope):
+        return self
+
+    def optimize (self,prims):
+        return self
+
+    def infer (self,symtable,ctx):
+        return self._value.type
+
     
 class EPrimCall (Exp):
     # Call an underlying Python primitive, passing in Values
@@ -146,7 +1525,7 @@ class EPrimCall (Exp):
         self.expForm = "EPrimCall"
         self.is_basic = True
 
-    def typecheck (self,symtable):
+    def typecheck (self,symtable,ctx):
         # we'll never type check EPrimCall
         raise Exception("Type error: cannot type EPrimCall")
 
@@ -156,6 +1535,15 @@ class EPrimCall (Exp):
     def eval (self,env):
         return eval_iter(self,env)
 
+    def resolve (self,scope):
+        return EPrimCall(self._prim,[ e.resolve(scope) for e in self._exps ])
+
+    def optimize (self,prims):
+        return fold_prim(self._prim,[ e.optimize(prims) for e in self._exps ])
+
+    def infer (self,symtable,ctx):
+        raise Exception("Type error: cannot type EPrimCall")
+
 
 class EIf (Exp):
     # Conditional expression
@@ -167,11 +1555,11 @@ class EIf (Exp):
         self.expForm = "EIf"
         self.is_basic = False
 
-    def typecheck (self,symtable):
+    def typecheck (self,symtable,ctx):
         # type is the type of the then part (checking will ensure the else part has the same type)
-        tcond = self._cond.typecheck(symtable)
-        tthen = self._then.typecheck(symtable)
-        telse = self._else.typecheck(symtable)
+        tcond = self._cond.typecheck(symtable,ctx)
+        tthen = self._then.typecheck(symtable,ctx)
+        telse = self._else.typecheck(symtable,ctx)
         if not tcond.isBoolean():
             raise Exception("Type error: EIf condition should be Boolean")
         if not tthen.isEqual(telse):
@@ -187,6 +1575,102 @@ class EIf (Exp):
     def eval (self,env):
         return eval_iter(self,env)
 
+    def resolve (self,scope):
+        return EIf(self._cond.resolve(scope),self._then.resolve(scope),self._else.resolve(scope))
+
+    def optimize (self,prims):
+        # a constant condition leaves only the branch it takes
+        cond = self._cond.optimize(prims)
+        if cond.expForm == "EValue" and isinstance(cond._value,VBoolean):
+            if cond._value.value:
+                return self._then.optimize(prims)
+            return self._else.optimize(prims)
+        return EIf(cond,self._then.optimize(prims),self._else.optimize(prims))
+
+    def infer (self,symtable,ctx):
+        tcond = self._cond.infer(symtable,ctx)
+        unify(tcond,TBoolean(),"EIf condition should be Boolean")
+        tthen = self._then.infer(symtable,ctx)
+        telse = self._else.infer(symtable,ctx)
+        unify(tthen,telse,"EIf then and else parts should be the same type")
+        return tthen
+
+
+class ESeq (Exp):
+    # Sequence of expressions, the value of the last one
+    # the others are only run for their effects, so they are of type none
+
+    def __init__ (self,es):
+        self._exps = es
+        self.expForm = "ESeq"
+        self.is_basic = False
+
+    def typecheck (self,symtable,ctx):
+        for e in self._exps[:-1]:
+            if not TNone().isEqual(e.typecheck(symtable,ctx)):
+                raise Exception("Type error: ESeq statements should be of type none")
+        return self._exps[-1].typecheck(symtable,ctx)
+
+    def __str__ (self):
+        return "ESeq([{}])".format(",".join([ str(e) for e in self._exps ]))
+
+    def eval (self,env):
+        return eval_iter(self,env)
+
+    def resolve (self,scope):
+        return ESeq([ e.resolve(scope) for e in self._exps ])
+
+    def optimize (self,prims):
+        # constants before the last expression do nothing
+        es = [ e.optimize(prims) for e in self._exps ]
+        es = [ e for e in es[:-1] if e.expForm != "EValue" ] + es[-1:]
+        if len(es) == 1:
+            return es[0]
+        return ESeq(es)
+
+    def infer (self,symtable,ctx):
+        for e in self._exps[:-1]:
+            unify(e.infer(symtable,ctx),TNone(),"ESeq statements should be of type none")
+        return self._exps[-1].infer(symtable,ctx)
+
+
+class EWhile (Exp):
+    # Loop running the body as long as the condition is true
+    # the body is run for its effects, the loop itself is of type none
+
+    def __init__ (self,cond,body):
+        self._cond = cond
+        self._body = body
+        self.expForm = "EWhile"
+        self.is_basic = False
+
+    def typecheck (self,symtable,ctx):
+        if not self._cond.typecheck(symtable,ctx).isBoolean():
+            raise Exception("Type error: EWhile condition should be Boolean")
+        if not TNone().isEqual(self._body.typecheck(symtable,ctx)):
+            raise Exception("Type error: EWhile body should be of type none")
+        return TNone()
+
+    def __str__ (self):
+        return "EWhile({},{})".format(self._cond,self._body)
+
+    def eval (self,env):
+        return eval_iter(self,env)
+
+    def resolve (self,scope):
+        return EWhile(self._cond.resolve(scope),self._body.resolve(scope))
+
+    def optimize (self,prims):
+        cond = self._cond.optimize(prims)
+        if cond.expForm == "EValue" and cond._value is FALSE:
+            return EValue(VNone())
+        return EWhile(cond,self._body.optimize(prims))
+
+    def infer (self,symtable,ctx):
+        unify(self._cond.infer(symtable,ctx),TBoolean(),"EWhile condition should be Boolean")
+        unify(self._body.infer(symtable,ctx),TNone(),"EWhile body should be of type none")
+        return TNone()
+
 
     
 class EId (Exp):
@@ -197,11 +1681,11 @@ class EId (Exp):
         self.expForm = "EId"
         self.is_basic = True
 
-    def typecheck (self,symtable):
+    def typecheck (self,symtable,ctx):
         # type is that of the identifier in the symbol table
-        for (name,typ) in reversed(symtable):
-            if name == self._id:
-                return typ
+        typ = symtable.get(self._id)
+        if typ is not None:
+            return typ
         raise Exception("Type error: cannot find identifier {}".format(self._id))
 
     def __str__ (self):
@@ -210,6 +1694,55 @@ class EId (Exp):
     def eval (self,env):
         return eval_iter(self,env)
 
+    def resolve (self,scope):
+        (depth,slot) = scope.lookup(self._id)
+        return ELocal(self._id,depth,slot)
+
+    def optimize (self,prims):
+        return self
+
+    def infer (self,symtable,ctx):
+        typ = symtable.get(self._id)
+        if typ is not None:
+            # generic top-level functions get fresh type variables at each use
+            t = instantiate(typ,{})
+            if t is not typ:
+                # what this use instantiates them to, for specialize()
+                ctx.instances[self] = t
+            return t
+        raise Exception("Type error: cannot find identifier {}".format(self._id))
+
+
+class ELocal (Exp):
+    # identifier resolved to a lexical address:
+    # slot number in the frame found by following depth parent links
+
+    def __init__ (self,id,depth,slot):
+        self._id = id
+        self._depth = depth
+        self._slot = slot
+        self.expForm = "ELocal"
+        self.is_basic = True
+
+    def typecheck (self,symtable,ctx):
+        # resolution happens after type checking
+        raise Exception("Type error: cannot type ELocal")
+
+    def __str__ (self):
+        return "ELocal({},{},{})".format(self._id,self._depth,self._slot)
+
+    def eval (self,env):
+        return eval_frame(self,env)
+
+    def resolve (self,scope):
+        return self
+
+    def optimize (self,prims):
+        return self
+
+    def infer (self,symtable,ctx):
+        raise Exception("Type error: cannot type ELocal")
+
 
 class ECall (Exp):
     # Call a defined function in the function dictionary
@@ -221,11 +1754,10 @@ class ECall (Exp):
         self.expForm = "ECall"
         self.is_basic = False
 
-    def typecheck (self,symtable):
+    def typecheck (self,symtable,ctx):
         # type is the type of the result of the function
-        global typetable
-        old_typetable = typetable
-        tfun = self._fun.typecheck(symtable)
+        old_table = ctx.table
+        tfun = self._fun.typecheck(symtable,ctx)
         if not (tfun.isFunction()):
             raise Exception("Type error1: non-function in ECall, got {}".format(tfun))
         if len(tfun.params) != len(self._args):
@@ -234,49 +1766,49 @@ class ECall (Exp):
             #there are three cases that we want to check for each pair of params and args. when param is a function, a generic type, or just regular type
             if t.isFunction():
                 #when param is a function, we want to go through its own param and found/check each param's type
-                for i,j in zip(t.params, arg.typecheck(symtable).params):
+                for i,j in zip(t.params, arg.typecheck(symtable,ctx).params):
                     if i.isGen():
-                        found = search_table(i, typetable)
+                        found = search_table(i, ctx.table)
                         if found == False:
-                            typetable = typetable + [(i.type_name, j)]
-                            symtable = symtable + [(i.type_name, j)]
+                            ctx.table = ctx.table.set(i.type_name, j)
+                            symtable = symtable.set(i.type_name, j)
                         else:
                             if not found.type == j.type:
                                 if found.isGen():
-                                    typetable = typetable + [(i.type_name, j)]
-                                    symtable = symtable + [(i.type_name, j)]
+                                    ctx.table = ctx.table.set(i.type_name, j)
+                                    symtable = symtable.set(i.type_name, j)
                                 else:
                                     raise Exception("Type error3: wrong argument in ECall, expected {} got {}".format(j.type, found.type))             
                 if not t.result.isGen():
-                    if not t.isEqual(arg.typecheck(typetable)):
-                        raise Exception("Type error4: wrong argument in ECall, expected {} got {}".format(t,arg.typecheck(symtable)))            
+                    if not t.isEqual(arg.typecheck(ctx.table,ctx)):
+                        raise Exception("Type error4: wrong argument in ECall, expected {} got {}".format(t,arg.typecheck(symtable,ctx)))            
 
                 else:
-                    found = search_table(t.result, typetable)
+                    found = search_table(t.result, ctx.table)
                     if found == False:
-                        typetable = typetable + [(t.result.type_name, arg.typecheck(symtable).result)]
-                        symtable = symtable + [(t.result.type_name, arg.typecheck(symtable).result)]
+                        ctx.table = ctx.table.set(t.result.type_name, arg.typecheck(symtable,ctx).result)
+                        symtable = symtable.set(t.result.type_name, arg.typecheck(symtable,ctx).result)
                     else:
-                        if not found.type == arg.typecheck(symtable).result.type:
-                            raise Exception("Type error5: wrong argument in ECall, expected {} got {}".format(t,arg.typecheck(symtable)))            
-                typetable = old_typetable
+                        if not found.type == arg.typecheck(symtable,ctx).result.type:
+                            raise Exception("Type error5: wrong argument in ECall, expected {} got {}".format(t,arg.typecheck(symtable,ctx)))            
+                ctx.table = old_table
             #if the param is not a function and not generic type, then it must have a type already, so we will need to check the param and the arg type
             elif not t.isGen():
-                if not t.isEqual(arg.typecheck(symtable)):
-                    raise Exception("Type error6: wrong argument in ECall, expected {} got {}".format(t,arg.typecheck(symtable)))
+                if not t.isEqual(arg.typecheck(symtable,ctx)):
+                    raise Exception("Type error6: wrong argument in ECall, expected {} got {}".format(t,arg.typecheck(symtable,ctx)))
             #if the param is generic, then we will either find it in the table or set the type
             else:
                 found = search_table(t, symtable)
                 if found == False:
-                    typetable = typetable + [(t.type_name, arg.typecheck(symtable))]  
-                    symtable = symtable + [(t.type_name, arg.typecheck(symtable))]  
+                    ctx.table = ctx.table.set(t.type_name, arg.typecheck(symtable,ctx))  
+                    symtable = symtable.set(t.type_name, arg.typecheck(symtable,ctx))  
                 else:
-                    if not found.isEqual(arg.typecheck(symtable)):
+                    if not found.isEqual(arg.typecheck(symtable,ctx)):
                         if found.isGen():
-                            typetable = typetable + [(t.type_name, arg.typecheck(symtable))]
-                            symtable = symtable + [(t.type_name, arg.typecheck(symtable))]
+                            ctx.table = ctx.table.set(t.type_name, arg.typecheck(symtable,ctx))
+                            symtable = symtable.set(t.type_name, arg.typecheck(symtable,ctx))
                         else:
-                            raise Exception("Type error7: wrong argument in ECall, expected {} got {}".format(found,arg.typecheck(symtable)))            
+                            raise Exception("Type error7: wrong argument in ECall, expected {} got {}".format(found,arg.typecheck(symtable,ctx)))            
         # if the result is a generic type, 
         if tfun.result.isGen():
             if hasattr(tfun.result, "type_name"):
@@ -296,6 +1828,27 @@ class ECall (Exp):
     def eval (self,env):
         return eval_iter(self,env)
 
+    def resolve (self,scope):
+        return ECall(self._fun.resolve(scope),[ e.resolve(scope) for e in self._args ])
+
+    def optimize (self,prims):
+        # a call to a primitive skips the closure and applies it directly
+        args = [ e.optimize(prims) for e in self._args ]
+        if self._fun.expForm == "EId" and self._fun._id in prims:
+            (prim,arity) = prims[self._fun._id]
+            if arity == len(args):
+                return fold_prim(prim,args)
+        return ECall(self._fun.optimize(prims),args)
+
+    def infer (self,symtable,ctx):
+        tfun = prune(self._fun.infer(symtable,ctx))
+        targs = [ e.infer(symtable,ctx) for e in self._args ]
+        if tfun.isFunction() and len(tfun.params) != len(targs):
+            raise Exception("Type error: wrong number of arguments in ECall, expected {} got {}".format(len(tfun.params),len(targs)))
+        tresult = TVar()
+        unify(tfun,TFunction(targs,tresult),"wrong argument in ECall")
+        return tresult
+
 
 class EFunction (Exp):
     # Creates an anonymous function
@@ -311,16 +1864,16 @@ class EFunction (Exp):
         else:
             self._param_types = [ TUnknown() for p in params]
 
-    def typecheck (self,symtable):
+    def typecheck (self,symtable,ctx):
         if self._name:
             # recursive function, so type check under the assumption that the current
             # function returns a value of type TAny (basically, any type), and read off
             # the body type we get as the final type
             # If TAny is the final type, we've just identified an infinite loop!
             tself = [(self._name,TFunction(self._param_types,TAny()))]
-            tbody = self._body.typecheck(symtable+zip(self._params,self._param_types)+tself)
+            tbody = self._body.typecheck(symtable.update(zip(self._params,self._param_types)+tself),ctx)
         else:
-            tbody = self._body.typecheck(zip(self._params,self._param_types) + symtable)
+            tbody = self._body.typecheck(symtable.update_missing(zip(self._params,self._param_types)),ctx)
         return TFunction(self._param_types,tbody)
 
     def __str__ (self):
@@ -329,13 +1882,599 @@ class EFunction (Exp):
     def eval (self,env):
         return eval_iter(self,env)
 
+    def resolve (self,scope):
+        # a recursive function keeps itself in slot 0 of its frame
+        names = list(self._params)
+        if self._name:
+            names.insert(0,self._name)
+        body = self._body.resolve(Scope(names,scope))
+        return EFunction(self._params,body,types=self._param_types,name=self._name)
+
+    def optimize (self,prims):
+        # the parameters and the name shadow primitives in the body
+        shadowed = [ p for p in list(self._params) + [self._name] if p in prims ]
+        if shadowed:
+            prims = dict(prims)
+            for name in shadowed:
+                del prims[name]
+        body = self._body.optimize(prims)
+        return EFunction(self._params,body,types=self._param_types,name=self._name)
+
+    def infer (self,symtable,ctx):
+        tparams = [ from_annotation(t,ctx.gens) for t in self._param_types ]
+        if self._name:
+            # recursive function: the result type is whatever the body says it is
+            tresult = TVar()
+            symtable = symtable.set(self._name,TFunction(tparams,tresult))
+        tbody = self._body.infer(symtable.update(zip(self._params,tparams)),ctx)
+        if self._name:
+            unify(tresult,tbody,"recursive function result")
+        return TFunction(tparams,tbody)
+
+#
+# Type checking context
+#
+# the state of one type check is passed down to the typecheck() and
+# infer() methods instead of living in globals, so that checks can run
+# at the same time in several threads and a failed check leaves nothing
+# behind
+#
+# table: the symbol table, extended with the types typecheck() found
+#   for the generic types of the calls checked so far
+# gens: the type variables infer() made of the generic types of the form
+# instances: the uses of generic globals and the types infer() gave them,
+#   see specialize_exp()
+
+class TypeContext (object):
+
+    def __init__ (self,symtable):
+        self.table = symtable
+        self.gens = {}
+        self.instances = {}
+
+#
+# Type inference
+#
+# an alternative to typecheck(): every expression is visited exactly once,
+# generic types <T> become type variables (TVar) that are bound by
+# unification, with union-find links between variables
+#
+# within one top-level form, <T> always names the same variable (ctx.gens);
+# generic types in the symbol table get fresh variables at each use
+
+def prune (t):
+    # follow the links of bound type variables, compressing the path
+    if isinstance(t,TVar) and t.instance is not None:
+        t.instance = prune(t.instance)
+        return t.instance
+    return t
+
+def occurs (v,t):
+    t = prune(t)
+    if t is v:
+        return True
+    if t.isFunction():
+        return any([ occurs(v,p) for p in t.params ]) or occurs(v,t.result)
+    if t.isRef():
+        return occurs(v,t.content)
+    return False
+
+def unify (t1,t2,what):
+    t1 = prune(t1)
+    t2 = prune(t2)
+    if t1 is t2:
+        return
+    if isinstance(t1,TVar) and isinstance(t2,TVar) and t1.name and not t2.name:
+        # keep the name written in the program
+        t2.instance = t1
+    elif isinstance(t1,TVar):
+        if occurs(t1,t2):
+            raise Exception("Type error: {}, recursive type {} in {}".format(what,t1,t2))
+        t1.instance = t2
+    elif isinstance(t2,TVar):
+        unify(t2,t1,what)
+    elif t1.isAny() or t2.isAny():
+        return
+    elif t1.isFunction() and t2.isFunction() and len(t1.params) == len(t2.params):
+        for (p1,p2) in zip(t1.params,t2.params):
+            unify(p1,p2,what)
+        unify(t1.result,t2.result,what)
+    elif t1.isRef() and t2.isRef():
+        unify(t1.content,t2.content,what)
+    elif not (t1.type == t2.type and t1.type in ("integer","boolean","none")):
+        raise Exception("Type error: {}, expected {} got {}".format(what,t1,t2))
+
+def from_annotation (t,gens):
+    # turn a type written in the program into a type with variables
+    if t.isGen():
+        if t.type_name not in gens:
+            gens[t.type_name] = TVar(t.type_name)
+        return gens[t.type_name]
+    if t.isFunction():
+        return TFunction([ from_annotation(p,gens) for p in t.params ],from_annotation(t.result,gens))
+    if t.isRef():
+        return TRef(from_annotation(t.content,gens))
+    if t.type == "???":
+        return TVar()
+    return t
+
+def instantiate (t,fresh):
+    # replace the generic types in t by fresh type variables,
+    # returning t itself when there are none
+    if t.isGen():
+        if t.type_name not in fresh:
+            fresh[t.type_name] = TVar(t.type_name)
+        return fresh[t.type_name]
+    if t.isFunction():
+        params = [ instantiate(p,fresh) for p in t.params ]
+        result = instantiate(t.result,fresh)
+        if result is t.result and all([ p is q for (p,q) in zip(params,t.params) ]):
+            return t
+        return TFunction(params,result)
+    if t.isRef():
+        content = instantiate(t.content,fresh)
+        return t if content is t.content else TRef(content)
+    return t
+
+def generalize (t,names):
+    # replace the unbound type variables in t by generic types
+    # names maps each variable to its generic type so names stay unique
+    t = prune(t)
+    if isinstance(t,TVar):
+        if t not in names:
+            used = set([ g.type_name for g in names.values() ])
+            name = t.name
+            n = 1
+            while name is None or name in used:
+                name = "{}{}".format(t.name or "T",n)
+                n += 1
+            names[t] = TGen(name)
+        return names[t]
+    if t.isFunction():
+        return TFunction([ generalize(p,names) for p in t.params ],generalize(t.result,names))
+    if t.isRef():
+        return TRef(generalize(t.content,names))
+    return t
+
+def infer_type (exp,symtable,ctx=None):
+    # the type of a top-level expression, by unification
+    if ctx is None:
+        ctx = TypeContext(symtable)
+    return generalize(exp.infer(symtable,ctx),{})
+
+def typecheck_top (exp,symtable,checker,ctx=None):
+    # type check a top-level expression with the chosen checker
+    if ctx is None:
+        ctx = TypeContext(symtable)
+    if checker == "infer":
+        return infer_type(exp,symtable,ctx)
+    return exp.typecheck(symtable,ctx)
+
+#
+# Type memoization
+#
+# a type checked top-level expression remembers its type, together with
+# the types of the global bindings it refers to at that point (its stamp)
+# the type is reused as long as none of those bindings has been replaced,
+# so adding a binding only re-checks the expressions that refer to it
+# typecheck() looks generic types up in the symbol table too, so a
+# binding of T matters to an expression that meets the generic type <T>
+# (see checked_names())
+#
+
+def free_ids (exp):
+    # identifiers occurring free in exp, computed once per node
+    try:
+        return exp._free_ids
+    except AttributeError:
+        pass
+    form = exp.expForm
+    if form == "EId":
+        ids = frozenset([exp._id])
+    elif form == "EIf":
+        ids = free_ids(exp._cond) | free_ids(exp._then) | free_ids(exp._else)
+    elif form == "ECall":
+        ids = free_ids(exp._fun).union(*[ free_ids(e) for e in exp._args ])
+    elif form == "EPrimCall" or form == "ESeq":
+        ids = frozenset().union(*[ free_ids(e) for e in exp._exps ])
+    elif form == "EWhile":
+        ids = free_ids(exp._cond) | free_ids(exp._body)
+    elif form == "EFunction" and exp._name:
+        ids = free_ids(exp._body).difference(exp._params,[exp._name])
+    elif form == "EFunction":
+        # the typecheck() methods check an anonymous function with the
+        # globals shadowing its parameters (update_missing), so the type
+        # of a global with the name of a parameter matters too
+        ids = free_ids(exp._body)
+    else:
+        ids = frozenset()
+    exp._free_ids = ids
+    return ids
+
+def gen_names (t):
+    # the names of the generic types occurring in type t
+    if isinstance(t,TGen):
+        return frozenset([t.type_name])
+    if isinstance(t,TFunction):
+        return gen_names(t.result).union(*[ gen_names(p) for p in t.params ])
+    if isinstance(t,TRef):
+        return gen_names(t.content)
+    return frozenset()
+
+def annotation_names (exp):
+    # the names of the generic types in the annotations of exp
+    form = exp.expForm
+    if form == "EIf":
+        return annotation_names(exp._cond) | annotation_names(exp._then) | annotation_names(exp._else)
+    if form == "ECall":
+        return annotation_names(exp._fun).union(*[ annotation_names(e) for e in exp._args ])
+    if form == "EPrimCall" or form == "ESeq":
+        return frozenset().union(*[ annotation_names(e) for e in exp._exps ])
+    if form == "EWhile":
+        return annotation_names(exp._cond) | annotation_names(exp._body)
+    if form == "EFunction":
+        return annotation_names(exp._body).union(*[ gen_names(t) for t in exp._param_types ])
+    return frozenset()
+
+def checked_names (exp,symtable):
+    # the global names whose bindings checking exp reads: its free
+    # identifiers, and the generic types of its annotations and of the
+    # types bound to those names, as typecheck() looks them up too
+    names = set(free_ids(exp)) | annotation_names(exp)
+    todo = list(names)
+    while todo:
+        t = symtable.get(todo.pop())
+        if t is not None:
+            for name in gen_names(t) - names:
+                names.add(name)
+                todo.append(name)
+    return names
+
+def typecheck_cached (exp,symtable,checker):
+    cached = getattr(exp,"_type_cache",None)
+    if cached is not None and cached[0] == checker:
+        if all([ symtable.get(name) is typ for (name,typ) in cached[1] ]):
+            return cached[2]
+    t = typecheck_top(exp,symtable,checker)
+    stamp = [ (name,symtable.get(name)) for name in checked_names(exp,symtable) ]
+    exp._type_cache = (checker,stamp,t)
+    return t
+
+#
+# Optimization
+#
+# runs after type checking: calls to identifiers bound to primitives
+# (and not shadowed) become EPrimCall nodes, EPrimCall nodes of pure
+# primitives with constant arguments become their value, and EIf nodes
+# with a constant condition become the branch they take
+# like resolve(), optimize() builds new nodes and leaves its input alone
+#
+# prims maps the names of primitives to (primitive, number of arguments)
+
+def fold_prim (prim,args):
+    if prim in PURE_PRIMS and all([ e.expForm == "EValue" for e in args ]):
+        try:
+            return EValue(apply(prim,[ e._value for e in args ]))
+        except Exception:
+            # leave the error to evaluation
+            pass
+    return EPrimCall(prim,args)
+
+def primitive_of (v):
+    # the primitive that a closure stands for, if its body does nothing
+    # but apply it to the parameters in order, as in initial_env()
+    if not isinstance(v,VClosure) or v._body.expForm != "EPrimCall":
+        return None
+    if [ getattr(e,"_id",None) for e in v._body._exps ] != list(v._params):
+        return None
+    return v._body._prim
+
+def known_primitives (env,engine):
+    # the global bindings of the engine that are primitives;
+    # later bindings of a name replace earlier ones
+    # this looks at every binding: a session keeps its table up to
+    # date with bind_primitive() instead
+    if engine in LIST_ENGINES:
+        bindings = env
+    else:
+        (scope,frame) = env
+        bindings = zip(scope.names,frame.slots)
+    prims = {}
+    for (name,v) in bindings:
+        bind_primitive(prims,name,v)
+    return prims
+
+def bind_primitive (prims,name,v):
+    # update the table of known_primitives() for a binding of name to v
+    prim = primitive_of(v)
+    if prim is None:
+        prims.pop(name,None)
+    else:
+        prims[name] = (prim,len(v._params))
+
+def optimize_top (exp,env,engine):
+    return exp.optimize(known_primitives(env,engine))
+
+
+#
+# Memoization
+#
+# a top-level function is pure when running it can only compute a value:
+# it never reaches ref, deref, update! or print!, and it only calls
+# itself and pure globals; deref counts as impure since the contents
+# of a cell can change between two calls with the same arguments
+# calls to parameters or to computed functions may be anything, so
+# they are impure too
+#
+# with #memo on, every pure function gets an LRUCache of its results,
+# keyed on its arguments when they are all integers, booleans or none
+
+MEMO_SIZE = 1024
+
+# the result of a cache miss, since raw results may be 0 or False
+MEMO_MISS = object()
+
+def is_pure (exp,pure,local=frozenset(),selfs=frozenset()):
+    # pure maps global names to their purity, local holds the names
+    # bound inside exp, selfs the names of the enclosing functions
+    # that still refer to those functions
+    form = exp.expForm
+    if form == "EValue":
+        return True
+    if form == "EId":
+        return exp._id in local or pure.get(exp._id,False)
+    if form == "EIf":
+        return (is_pure(exp._cond,pure,local,selfs) and
+                is_pure(exp._then,pure,local,selfs) and
+                is_pure(exp._else,pure,local,selfs))
+    if form == "ESeq":
+        return all([ is_pure(e,pure,local,selfs) for e in exp._exps ])
+    if form == "EWhile":
+        return is_pure(exp._cond,pure,local,selfs) and is_pure(exp._body,pure,local,selfs)
+    if form == "EPrimCall":
+        return (exp._prim in PURE_PRIMS and
+                all([ is_pure(e,pure,local,selfs) for e in exp._exps ]))
+    if form == "ECall":
+        fun = exp._fun
+        if fun.expForm != "EId":
+            return False
+        if fun._id in local:
+            if fun._id not in selfs:
+                return False
+        elif not pure.get(fun._id,False):
+            return False
+        return all([ is_pure(e,pure,local,selfs) for e in exp._args ])
+    if form == "EFunction":
+        params = frozenset(exp._params)
+        names = frozenset([exp._name]) if exp._name else frozenset()
+        return is_pure(exp._body,pure,local | params | names,(selfs | names) - params)
+    # resolved nodes only show up after the analysis
+    return False
+
+def is_pure_value (v,seen=None):
+    # is_pure() for a value at run time: anything but a closure is pure,
+    # and a closure is pure when its body is, the identifiers it did not
+    # bind standing for the values it captured; seen holds the closures
+    # being checked, which recursive calls may reach again
+    if v.__class__ is Thunk:
+        if v.value is not None:
+            return is_pure_value(v.value,seen)
+        return is_pure_captured(v.exp,v,frozenset(),frozenset(),0,seen or set())
+    if not isinstance(v,VClosure):
+        return True
+    prim = primitive_of(v)
+    if prim is not None:
+        # including the functions pmap returns
+        return prim in PURE_PRIMS or isinstance(prim,PMapTable)
+    if seen is None:
+        seen = set()
+    if id(v) in seen:
+        return True
+    seen.add(id(v))
+    names = frozenset([v._name]) if v._name else frozenset()
+    return is_pure_captured(v._body,v,frozenset(v._params) | names,names,0,seen)
+
+def captured_value (exp,owner,depth):
+    # the value of the free identifier exp of the body of owner, a closure
+    # or a thunk, seen from depth functions nested in that body
+    if exp.expForm == "ELocal":
+        frame = owner._frame
+        for i in xrange(exp._depth - depth - 1):
+            frame = frame.parent
+        return frame.slots[exp._slot]
+    for (id,v) in reversed(owner._env if isinstance(owner,VClosure) else owner.env):
+        if exp._id == id:
+            return v
+    return None
+
+def is_pure_captured (exp,owner,local,selfs,depth,seen):
+    # is_pure() over the body of owner; local and selfs as in is_pure(),
+    # depth counts the functions entered, for ELocal nodes
+    form = exp.expForm
+    if form == "EValue":
+        return True
+    if form == "EId" or form == "ELocal":
+        if (exp._depth <= depth) if form == "ELocal" else (exp._id in local):
+            return True
+        return is_pure_value(captured_value(exp,owner,depth),seen)
+    if form == "EIf":
+        return all([ is_pure_captured(e,owner,local,selfs,depth,seen)
+                     for e in (exp._cond,exp._then,exp._else) ])
+    if form == "EWhile":
+        return all([ is_pure_captured(e,owner,local,selfs,depth,seen)
+                     for e in (exp._cond,exp._body) ])
+    if form == "ESeq":
+        return all([ is_pure_captured(e,owner,local,selfs,depth,seen) for e in exp._exps ])
+    if form == "EPrimCall":
+        return (exp._prim in PURE_PRIMS and
+                all([ is_pure_captured(e,owner,local,selfs,depth,seen) for e in exp._exps ]))
+    if form == "ECall":
+        fun = exp._fun
+        if fun.expForm not in ("EId","ELocal"):
+            return False
+        if (fun._depth <= depth) if fun.expForm == "ELocal" else (fun._id in local):
+            # a local function is only known when it is an enclosing one
+            if fun._id not in selfs:
+                return False
+        elif not is_pure_value(captured_value(fun,owner,depth),seen):
+            return False
+        return all([ is_pure_captured(e,owner,local,selfs,depth,seen) for e in exp._args ])
+    if form == "EFunction":
+        params = frozenset(exp._params)
+        names = frozenset([exp._name]) if exp._name else frozenset()
+        return is_pure_captured(exp._body,owner,local | params | names,(selfs | names) - params,
+                                depth + 1,seen)
+    return False
+
+def memo_key (args):
+    # a hashable key for the arguments, or None when they cannot be compared
+    key = []
+    for a in args:
+        if a.__class__ is bool or a.__class__ is VBoolean:
+            key.append((bool,a is True or a is TRUE))
+        elif a.__class__ is int or a.__class__ is long:
+            key.append((int,a))
+        elif a.__class__ is VInteger:
+            key.append((int,a.value))
+        elif a.__class__ is VNone:
+            key.append((None,))
+        else:
+            return None
+    return tuple(key)
+
+def memo_call (f,args,apply):
+    # call f through its cache; apply(f,args) runs it without the cache
+    key = memo_key(args)
+    if key is None:
+        return apply(f,args)
+    v = f._memo.get(key,MEMO_MISS)
+    if v is MEMO_MISS:
+        v = apply(f,args)
+        f._memo.put(key,v)
+    return v
+
+
+class Memoizer (object):
+    # the purity of the global names of a session, and the pure
+    # top-level functions that are memoized when it is enabled
+
+    def __init__ (self,size=MEMO_SIZE):
+        self.enabled = False
+        self.size = size
+        self.pure = dict([ (name,primitive_of(v) in PURE_PRIMS) for (name,v) in initial_env() ])
+        # name -> closure, in the order of their definitions
+        self.functions = OrderedDict()
+
+    def define (self,name,exp,value):
+        # record a top-level definition of name as exp, evaluated to value
+        pure = is_pure(exp,self.pure)
+        self.pure[name] = pure
+        old = self.functions.pop(name,None)
+        if old is not None:
+            # closures that captured the old function still call it,
+            # and #memo off could no longer reach its cache
+            old._memo = None
+        if pure and exp.expForm == "EFunction" and isinstance(value,VClosure):
+            self.functions[name] = value
+            if self.enabled:
+                value._memo = LRUCache(self.size)
+        return pure
+
+    def enable (self,on):
+        self.enabled = on
+        for f in self.functions.values():
+            f._memo = LRUCache(self.size) if on else None
+
+    def reset (self):
+        for f in self.functions.values():
+            if f._memo is not None:
+                f._memo.clear()
+
+    def report (self):
+        lines = ["[Memoization {}, {} entries per function]".format("on" if self.enabled else "off",self.size)]
+        if not self.functions:
+            lines.append("  no pure functions")
+        for (name,f) in self.functions.items():
+            if f._memo is None:
+                lines.append("  {}".format(name))
+            else:
+                lines.append("  {:<16} {:>8} hits {:>8} misses {:>6} entries".format(
+                    name,f._memo.hits,f._memo.misses,len(f._memo)))
+        return "\n".join(lines)
+
+
+#
+# Specialization
+#
+# a generic top-level function is used at concrete types by most calls
+# when inference of a form finds a use of one at a ground type, the
+# session makes a copy of the function with those parameter types,
+# checks and evaluates it once, and binds it under a name that no
+# program can write; the use is then rewritten to refer to the copy,
+# which the unboxed engine can call with raw arguments
+# copies are only made when optimizing
+
+def concrete (t):
+    # t with its type variables replaced by what they are bound to,
+    # or None when that is not a ground type
+    t = prune(t)
+    if t.isFunction():
+        params = [ concrete(p) for p in t.params ]
+        result = concrete(t.result)
+        if result is None or None in params:
+            return None
+        return TFunction(params,result)
+    if t.isRef():
+        content = concrete(t.content)
+        return None if content is None else TRef(content)
+    return t if t.ground else None
+
+def specialize_exp (exp,instances,instance):
+    # exp with the uses of generic functions in instances, recorded by
+    # infer(), replaced by their copies; instance(name,type) gives the
+    # name of the copy, or None; unchanged subexpressions are shared
+    form = exp.expForm
+    if form == "EId":
+        t = instances.get(exp)
+        t = None if t is None else concrete(t)
+        name = None if t is None else instance(exp._id,t)
+        return exp if name is None else EId(name)
+    if form == "EIf":
+        parts = [ specialize_exp(e,instances,instance) for e in (exp._cond,exp._then,exp._else) ]
+        if all([ p is e for (p,e) in zip(parts,(exp._cond,exp._then,exp._else)) ]):
+            return exp
+        return EIf(*parts)
+    if form == "EWhile":
+        cond = specialize_exp(exp._cond,instances,instance)
+        body = specialize_exp(exp._body,instances,instance)
+        if cond is exp._cond and body is exp._body:
+            return exp
+        return EWhile(cond,body)
+    if form == "ECall":
+        fun = specialize_exp(exp._fun,instances,instance)
+        args = [ specialize_exp(e,instances,instance) for e in exp._args ]
+        if fun is exp._fun and all([ a is e for (a,e) in zip(args,exp._args) ]):
+            return exp
+        return ECall(fun,args)
+    if form == "EPrimCall" or form == "ESeq":
+        exps = [ specialize_exp(e,instances,instance) for e in exp._exps ]
+        if all([ a is e for (a,e) in zip(exps,exp._exps) ]):
+            return exp
+        return EPrimCall(exp._prim,exps) if form == "EPrimCall" else ESeq(exps)
+    if form == "EFunction":
+        body = specialize_exp(exp._body,instances,instance)
+        if body is exp._body:
+            return exp
+        return EFunction(exp._params,body,types=exp._param_types,name=exp._name)
+    return exp
+
 #
 # Helper Functions
 #
 
 def transform_type(fun, symtable):
     new_params = []
-    new_fun = TFunction([], TNone)
+    new_result = TNone
     for i in fun.params:
         if i.isFunction():
             transform_type(i, symtable)
@@ -354,76 +2493,204 @@ def transform_type(fun, symtable):
     else:
         found = search_table(fun.result, symtable)
         if found:
-            new_fun.result = found
+            new_result = found
         else:
-            new_fun.result = fun.result
-    new_fun.params = new_params
-    return new_fun
+            new_result = fun.result
+    return TFunction(new_params, new_result)
 
 
 #
 # Values
 #
 
+# values use __slots__ instead of a __dict__, and the type of
+# integers, Booleans and none is a property of the class rather than an
+# object per value
+#
+# integers, Booleans and none are never mutated, so VBoolean and VNone
+# only ever create two and one instances, and VInteger shares the
+# instances of small integers
+#
+# values are pickled to send them to the processes of pmap: the
+# __reduce__ methods go through the constructors to keep the shared
+# instances shared
+
 class Value (object):
-    pass
+    __slots__ = ()
 
 
+SMALL_INT_MIN = -128
+SMALL_INT_MAX = 1024
+
 class VInteger (Value):
     # Value representation of integers
-    
-    def __init__ (self,i):
-        self.value = i
-        self.type = TInteger()
+    __slots__ = ("value",)
+
+    def __new__ (cls,i):
+        if SMALL_INT_MIN <= i < SMALL_INT_MAX:
+            return SMALL_INTS[i - SMALL_INT_MIN]
+        v = Value.__new__(cls)
+        v.value = i
+        return v
+
+    @property
+    def type (self):
+        return TInteger()
+
+    def __reduce__ (self):
+        return (VInteger,(self.value,))
 
     def __str__ (self):
         return str(self.value)
 
+
+def _make_small_int (i):
+    v = Value.__new__(VInteger)
+    v.value = i
+    return v
+
+SMALL_INTS = [ _make_small_int(i) for i in range(SMALL_INT_MIN,SMALL_INT_MAX) ]
+
     
 class VBoolean (Value):
     # Value representation of Booleans
-    
-    def __init__ (self,b):
-        self.value = b
-        self.type = TBoolean()
+    __slots__ = ("value",)
+
+    def __new__ (cls,b):
+        return TRUE if b else FALSE
+
+    @property
+    def type (self):
+        return TBoolean()
+
+    def __reduce__ (self):
+        return (VBoolean,(self.value,))
 
     def __str__ (self):
         return "true" if self.value else "false"
 
+
+TRUE = Value.__new__(VBoolean)
+TRUE.value = True
+FALSE = Value.__new__(VBoolean)
+FALSE.value = False
+
     
 class VClosure (Value):
+    __slots__ = ("_params","_body","_name","_env","_frame","_code","_bytecode","_raw","_memo","type")
     
-    def __init__ (self,params,body,env,name=None):
+    def __init__ (self,params,body,env,name=None,frame=None,code=None,bytecode=None):
         self._params = params
         self._body = body
+        self._name = name
         extra = [(name,self)] if name else []
         self._env = env + extra
+        # only used by eval_frame, compiled code and the VM
+        self._frame = frame
+        self._code = code
+        self._bytecode = bytecode
+        self._raw = None
+        # LRUCache of results when the function is memoized
+        self._memo = None
         self.type = TFunction([ TUnknown() for p in params],TUnknown())
 
+    def __getstate__ (self):
+        # compiled code and caches are rebuilt on demand, as boxed code
+        # for a closure of the unboxed engine, whose frames are boxed
+        frame = self._frame
+        if self._raw is not None:
+            frame = boxed_frames(frame,self._raw[3])
+        return (self._params,self._body,self._name,self._env,frame,self.type)
+
+    def __setstate__ (self,state):
+        (self._params,self._body,self._name,self._env,self._frame,self.type) = state
+        self._code = None
+        self._bytecode = None
+        self._raw = None
+        self._memo = None
+
     def __str__ (self):
         return "<function [{}] {}>".format(",".join(self._params),str(self._body))
 
 
     
 class VRefCell (Value):
+    __slots__ = ("content","type")
 
     def __init__ (self,initial):
         self.content = initial
         self.type = TRef(initial.type)
 
+    def __getstate__ (self):
+        return (self.content,self.type)
+
+    def __setstate__ (self,state):
+        (self.content,self.type) = state
+
     def __str__ (self):
         return "<ref {}>".format(str(self.content))
 
 
 class VNone (Value):
+    __slots__ = ()
 
-    def __init__ (self):
-        self.type = TNone()
+    def __new__ (cls):
+        return NONE
+
+    @property
+    def type (self):
+        return TNone()
+
+    def __reduce__ (self):
+        return (VNone,())
 
     def __str__ (self):
         return "none"
 
 
+NONE = Value.__new__(VNone)
+
+
+
+#
+# Frames and scopes for resolved expressions
+#
+# A Scope is the compile-time picture of a Frame: the names bound
+# in each slot, and the enclosing scope
+
+class Scope (object):
+
+    def __init__ (self,names,parent=None):
+        self.names = names
+        self.parent = parent
+
+    def lookup (self,id):
+        depth = 0
+        scope = self
+        while scope:
+            # later slots shadow earlier ones
+            for slot in reversed(xrange(len(scope.names))):
+                if scope.names[slot] == id:
+                    return (depth,slot)
+            depth += 1
+            scope = scope.parent
+        raise Exception("Cannot resolve identifier {}".format(id))
+
+
+class Frame (object):
+    __slots__ = ("slots","parent")
+
+    def __init__ (self,slots,parent=None):
+        self.slots = slots
+        self.parent = parent
+
+    def __getstate__ (self):
+        return (self.slots,self.parent)
+
+    def __setstate__ (self,state):
+        (self.slots,self.parent) = state
+
+
 
 
 # Primitive operations
@@ -454,6 +2721,98 @@ def oper_print (v1):
     print v1
     return VNone()
 
+# primitives without side effects, the ones the optimizer folds
+PURE_PRIMS = frozenset([oper_plus,oper_minus,oper_times,oper_zero])
+
+
+# Parallel map
+#
+# (pmap f n) applies f to 0 ... n-1 in a pool of worker processes and
+# returns a function from i to the result of (f i)
+# f and its results are pickled to and from the workers, so f must be
+# pure (see is_pure_value()): its prints would happen in the workers,
+# and its updates to reference cells would be lost
+#
+# the arguments are split in PMAP_CHUNKS chunks per worker, so that
+# f is sent once per chunk rather than once per argument
+# there are PMAP_WORKERS workers, or one per CPU if it is None; with
+# a single worker, f runs in the interpreter itself
+
+PMAP_CHUNKS = 4
+PMAP_WORKERS = None
+
+_pmap_pool = None
+_pmap_workers = None
+
+def pmap_pool (workers):
+    # the pool is created on first use, and its workers forked
+    # at that point live as long as the interpreter, or until
+    # a pool of another size replaces them
+    global _pmap_pool, _pmap_workers
+    if _pmap_pool is not None and _pmap_workers != workers:
+        _pmap_pool.terminate()
+        _pmap_pool = None
+    if _pmap_pool is None:
+        _pmap_pool = multiprocessing.Pool(workers)
+        _pmap_workers = workers
+    return _pmap_pool
+
+def apply_value (f,args):
+    # call a closure of any engine, as a primitive has to
+    if f._frame is None:
+        return eval_iter(f._body,f._env + zip(f._params,args))
+    return call_value(f,list(args))
+
+def apply_need (f,args):
+    # apply_value() for a closure of engine need, whose environment may
+    # hold thunks; the result is a value, never a thunk
+    return eval_need(f._body,f._env + zip(f._params,args))
+
+def pmap_chunk (task):
+    (f,lo,hi,apply_f) = task
+    return [ apply_f(f,[VInteger(i)]) for i in xrange(lo,hi) ]
+
+
+class PMapTable (object):
+    # the primitive behind the function pmap returns
+    __name__ = "pmap_table"
+
+    def __init__ (self,values):
+        self.values = values
+
+    def __call__ (self,i):
+        if not 0 <= i.value < len(self.values):
+            raise Exception("Runtime error: pmap index {} out of range".format(i.value))
+        return self.values[i.value]
+
+
+def oper_pmap (f,n):
+    return pmap_values(f,n,apply_value)
+
+def oper_pmap_need (f,n):
+    # pmap of engine need
+    return pmap_values(f,n,apply_need)
+
+def pmap_values (f,n,apply_f):
+    # apply_f(f,args) calls f in the workers
+    if not is_pure_value(f):
+        # its effects would happen in the workers, and be lost there
+        raise Exception("Runtime error: pmap needs a pure function")
+    count = n.value
+    workers = PMAP_WORKERS or multiprocessing.cpu_count()
+    size = max(1,-(-count // (workers * PMAP_CHUNKS)))
+    tasks = [ (f,lo,min(lo+size,count),apply_f) for lo in xrange(0,count,size) ]
+    if len(tasks) < 2 or workers < 2 or multiprocessing.current_process().daemon:
+        # workers cannot have workers of their own
+        chunks = map(pmap_chunk,tasks)
+    else:
+        chunks = pmap_pool(workers).map(pmap_chunk,tasks,1)
+    table = PMapTable([ v for chunk in chunks for v in chunk ])
+    # the result is a closure of the same engine as f
+    if f._frame is None:
+        return VClosure(["i"],EPrimCall(table,[EId("i")]),[])
+    return VClosure(["i"],EPrimCall(table,[ELocal("i",0,0)]),[],frame=Frame([]))
+
 
 
 
@@ -462,14 +2821,137 @@ def oper_print (v1):
 ## PARSER
 ##
 # cf http://pyparsing.wikispaces.com/
+#
+# there are two parsers for the same syntax: the pyparsing grammar of
+# make_grammar(), and Reader, a tokenizer and recursive descent reader
+# written by hand; parse() and parse_program() take the name of the one
+# to use, and set_parser() picks the one they use by default
+# pyparsing is only imported when its parser is used
+
+import re
+from collections import OrderedDict
+
 
-from pyparsing import Word, Literal, ZeroOrMore, OneOrMore, Keyword, Forward, alphas, alphanums, NoMatch, Group
+class LRUCache (object):
+    # a dictionary holding at most size entries,
+    # dropping the least recently used one when full
 
+    def __init__ (self,size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
 
-def parse (input):
+    def get (self,key,default=None):
+        try:
+            value = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.entries[key] = value
+        self.hits += 1
+        return value
+
+    def put (self,key,value):
+        if self.size <= 0:
+            return
+        self.entries.pop(key,None)
+        self.entries[key] = value
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def resize (self,size):
+        self.size = size
+        while len(self.entries) > max(size,0):
+            self.entries.popitem(last=False)
+
+    def clear (self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__ (self):
+        return len(self.entries)
+
+
+# the grammar is built once, on the first call to parse()
+# parsed results are cached by parser and input string; they are shared
+# between callers and Interpreter sessions, which is fine because nothing
+# mutates an abstract representation (the caches of free_ids() and
+# typecheck_cached() hold what any session would compute)
+
+PARSERS = ("reader","pyparsing")
+
+_parser = "reader"
+_grammar = None
+_program_grammar = None
+parse_cache = LRUCache(256)
+
+def set_parse_cache_size (size):
+    # 0 disables the cache
+    parse_cache.resize(size)
+
+def set_parser (name):
+    global _parser
+    if name not in PARSERS:
+        raise Exception("Unknown parser {}".format(name))
+    _parser = name
+
+def top_grammar ():
+    global _grammar
+    if _grammar is None:
+        from pyparsing import ParserElement
+        ParserElement.enablePackrat()
+        _grammar = make_grammar()
+    return _grammar
+
+def parse (input,parser=None):
     # parse a string into an element of the abstract representation
+    # like the grammar, this reads the first form and ignores the rest
+    parser = parser or _parser
+    result = parse_cache.get((parser,input))
+    if result is None:
+        if parser == "reader":
+            result = Reader(input).read_top()
+        else:
+            result = top_grammar().parseString(input)[0]   # the first element of the result is the expression
+        parse_cache.put((parser,input),result)
+    return result
+
+def parse_program (input,parser=None):
+    # parse a whole program into the list of its top-level forms
+    global _program_grammar
+    if (parser or _parser) == "reader":
+        return Reader(input).read_program()
+    if _program_grammar is None:
+        from pyparsing import ZeroOrMore, StringEnd
+        _program_grammar = ZeroOrMore(top_grammar()) + StringEnd()
+    return list(_program_grammar.parseString(input))
 
 
+# desugarings shared by both parsers
+# do and while used to become lets and a recursive function, they now
+# have nodes of their own that run without allocating closures
+
+def makeLet (bindings,types,body):
+    params = [ param for (param,exp) in bindings ]
+    args = [ exp for (param,exp) in bindings ]
+    return ECall(EFunction(params,body,types=types),args)
+
+def makeDo (exprs):
+    if len(exprs) == 1:
+        return exprs[0]
+    return ESeq(exprs)
+
+def makeWhile (cond,body):
+    return EWhile(cond,body)
+
+
+def make_grammar ():
+    # build the parser for a top-level form
+
+    from pyparsing import Word, Literal, ZeroOrMore, OneOrMore, Keyword, Forward, alphas, Group
+
     idChars = alphas+"_+*-?!="
 
     pIDENTIFIER = Word(idChars, idChars+"0123456789")
@@ -525,11 +3007,6 @@ def parse (input):
     pBINDINGS = ZeroOrMore(pBINDING)
     pBINDINGS.setParseAction(lambda result: [ result ])
 
-    def makeLet (bindings,types,body):
-        params = [ param for (param,exp) in bindings ]
-        args = [ exp for (param,exp) in bindings ]
-        return ECall(EFunction(params,body,types=types),args)
-
     pLET = "(" + Keyword("let") + "(" + pBINDINGS + ")" + pTYPES + pEXPR + ")"
     pLET.setParseAction(lambda result: makeLet(result[3],result[5],result[6]))
 
@@ -543,22 +3020,9 @@ def parse (input):
     pFUNrec = "(" + Keyword("function") + pNAME + "(" + pNAMES + ")" + pTYPES + pEXPR + ")"
     pFUNrec.setParseAction(lambda result: EFunction(result[4],result[7],types=result[6],name=result[2]))
 
-    def makeDo (exprs):
-        result = exprs[-1]
-        for e in reversed(exprs[:-1]):
-            # space is not an allowed identifier in the syntax!
-            result = makeLet([(" ",e)],[TNone()],result)
-        return result
-
     pDO = "(" + Keyword("do") + pEXPRS + ")"
     pDO.setParseAction(lambda result: makeDo(result[2]))
 
-    def makeWhile (cond,body):
-        return makeLet([(" while",
-                         EFunction([],EIf(cond,makeLet([(" ",body)],ECall(EId(" while"),[])),EValue(VNone())),name=" while"))],
-                       [TFunction([],TNone())],
-                       ECall(EId(" while"),[]))
-
     pWHILE = "(" + Keyword("while") + pEXPR + pEXPR + ")"
     pWHILE.setParseAction(lambda result: makeWhile(result[2],result[3]))
 
@@ -578,21 +3042,255 @@ def parse (input):
                                           "name":result[2],
                                           "params":result[4],
                                           "types":result[6],
-                                          "body":result[7]})
+                                          "body":result[7],
+                                          "fun":EFunction(result[4],result[7],types=result[6],name=result[2])})
 
     pABSTRACT = "#abs" + pEXPR
     pABSTRACT.setParseAction(lambda result: {"result":"abstract",
                                              "expr":result[1]})
 
+    pDIS = "#dis" + pEXPR
+    pDIS.setParseAction(lambda result: {"result":"dis",
+                                        "expr":result[1]})
+
+    pPROFILE = Keyword("#profile") + ZeroOrMore(Keyword("on") | Keyword("off") | Keyword("reset"))
+    pPROFILE.setParseAction(lambda result: {"result":"profile",
+                                            "action":result[1] if len(result) > 1 else "show"})
+
     pQUIT = Keyword("#quit")
     pQUIT.setParseAction(lambda result: {"result":"quit"})
-    
-    pTOP = (pDEFUN | pDEFINE | pQUIT | pABSTRACT | pTOPEXPR)
 
-    result = pTOP.parseString(input)[0]
-    return result    # the first element of the result is the expression
+    pMEMO = Keyword("#memo") + ZeroOrMore(Keyword("on") | Keyword("off") | Keyword("reset"))
+    pMEMO.setParseAction(lambda result: {"result":"memo",
+                                         "action":result[1] if len(result) > 1 else "show"})
 
+    pTOP = (pDEFUN | pDEFINE | pQUIT | pABSTRACT | pDIS | pPROFILE | pMEMO | pTOPEXPR)
 
+    return pTOP
+
+
+# the hand-written reader
+#
+# the tokenizer splits the input the way the grammar does: integers are
+# runs of digits, identifiers start with a letter or one of _+*-?!= and
+# go on with digits too, and "->" is a token of its own
+# the reader then looks at one token at a time and never backtracks:
+# a keyword at the head of a parenthesized form always starts that form,
+# where the grammar would fall back to reading a malformed form as a call
+
+ID_CHARS = "A-Za-z_+*\\-?!="
+
+TOKEN = re.compile(r"\s*(->|[()<>]|[0-9]+|[{0}][{0}0-9]*|#[A-Za-z]+|\S)".format(ID_CHARS))
+
+IDENTIFIER = re.compile(r"[{0}][{0}0-9]*$".format(ID_CHARS))
+
+COMMAND_ACTIONS = ("on","off","reset")
+
+class Reader (object):
+
+    def __init__ (self,input):
+        self.input = input
+        self.tokens = []
+        self.positions = []
+        for m in TOKEN.finditer(input):
+            self.tokens.append(m.group(1))
+            self.positions.append(m.start(1))
+        self.pos = 0
+
+    def error (self,expected):
+        if self.pos < len(self.tokens):
+            at = self.positions[self.pos]
+            found = "found '{}'".format(self.tokens[self.pos])
+        else:
+            at = len(self.input)
+            found = "found end of text"
+        line = self.input.count("\n",0,at) + 1
+        col = at - self.input.rfind("\n",0,at)
+        return Exception("Expected {}, {}  (at char {}), (line:{}, col:{})".format(expected,found,at,line,col))
+
+    def peek (self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None
+
+    def next (self,expected="a form"):
+        if self.pos >= len(self.tokens):
+            raise self.error(expected)
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def expect (self,token):
+        if self.peek() != token:
+            raise self.error("'{}'".format(token))
+        self.pos += 1
+
+    def read_name (self):
+        token = self.peek()
+        if token is None or not IDENTIFIER.match(token):
+            raise self.error("a name")
+        self.pos += 1
+        return token
+
+    def read_names (self):
+        self.expect("(")
+        names = []
+        while self.peek() != ")":
+            names.append(self.read_name())
+        self.pos += 1
+        return names
+
+    def read_type (self):
+        token = self.next("a type")
+        if token == "int":
+            return TInteger()
+        elif token == "bool":
+            return TBoolean()
+        elif token == "<":
+            name = self.read_name()
+            self.expect(">")
+            return TGen(name)
+        elif token == "(":
+            token = self.next("ref or ->")
+            if token == "ref":
+                t = TRef(self.read_type())
+            elif token == "->":
+                params = self.read_types()
+                if not params:
+                    self.pos -= 2
+                    raise self.error("a type")
+                t = TFunction(params,self.read_type())
+            else:
+                self.pos -= 1
+                raise self.error("ref or ->")
+            self.expect(")")
+            return t
+        self.pos -= 1
+        raise self.error("a type")
+
+    def read_types (self):
+        self.expect("(")
+        types = []
+        while self.peek() != ")":
+            types.append(self.read_type())
+        self.pos += 1
+        return types
+
+    def read_exprs (self):
+        # expressions up to the closing parenthesis, which is consumed
+        exprs = []
+        while self.peek() != ")":
+            exprs.append(self.read_expr())
+        self.pos += 1
+        return exprs
+
+    def read_expr (self):
+        token = self.next("an expression")
+        if token == "(":
+            return self.read_form()
+        elif token[0].isdigit():
+            return EValue(VInteger(int(token)))
+        elif token == "true" or token == "false":
+            return EValue(VBoolean(token == "true"))
+        elif IDENTIFIER.match(token):
+            return EId(token)
+        self.pos -= 1
+        raise self.error("an expression")
+
+    def read_form (self):
+        # the rest of a parenthesized expression
+        head = self.peek()
+        if head == "if":
+            self.pos += 1
+            cond = self.read_expr()
+            then = self.read_expr()
+            exp = EIf(cond,then,self.read_expr())
+        elif head == "let":
+            self.pos += 1
+            self.expect("(")
+            bindings = []
+            while self.peek() != ")":
+                self.expect("(")
+                name = self.read_name()
+                bindings.append((name,self.read_expr()))
+                self.expect(")")
+            self.pos += 1
+            types = self.read_types()
+            exp = makeLet(bindings,types,self.read_expr())
+        elif head == "function":
+            self.pos += 1
+            name = None if self.peek() == "(" else self.read_name()
+            params = self.read_names()
+            types = self.read_types()
+            exp = EFunction(params,self.read_expr(),types=types,name=name)
+        elif head == "do":
+            self.pos += 1
+            exprs = self.read_exprs()
+            if not exprs:
+                self.pos -= 1
+                raise self.error("an expression")
+            return makeDo(exprs)
+        elif head == "while":
+            self.pos += 1
+            cond = self.read_expr()
+            exp = makeWhile(cond,self.read_expr())
+        else:
+            fun = self.read_expr()
+            return ECall(fun,self.read_exprs())
+        self.expect(")")
+        return exp
+
+    def read_top (self):
+        # one top-level form, as the grammar's parse actions build it
+        token = self.peek()
+        if token == "(" and self.pos + 1 < len(self.tokens):
+            head = self.tokens[self.pos+1]
+            if head == "defun":
+                self.pos += 2
+                name = self.read_name()
+                params = self.read_names()
+                types = self.read_types()
+                body = self.read_expr()
+                self.expect(")")
+                return {"result":"function",
+                        "name":name,
+                        "params":params,
+                        "types":types,
+                        "body":body,
+                        "fun":EFunction(params,body,types=types,name=name)}
+            if head == "define":
+                self.pos += 2
+                name = self.read_name()
+                exp = self.read_expr()
+                self.expect(")")
+                return {"result":"value","name":name,"expr":exp}
+        if token == "#quit":
+            self.pos += 1
+            return {"result":"quit"}
+        if token == "#abs" or token == "#dis":
+            self.pos += 1
+            return {"result":"abstract" if token == "#abs" else "dis","expr":self.read_expr()}
+        if token == "#profile" or token == "#memo":
+            self.pos += 1
+            actions = []
+            while self.peek() in COMMAND_ACTIONS:
+                actions.append(self.next())
+            return {"result":token[1:],"action":actions[0] if actions else "show"}
+        return {"result":"expression","expr":self.read_expr()}
+
+    def read_program (self):
+        # the trees hold no cycles, so the cycle collector would only
+        # slow the reading of a large program down
+        forms = []
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            while self.pos < len(self.tokens):
+                forms.append(self.read_top())
+        finally:
+            if collecting:
+                gc.enable()
+        return forms
 
 
 def add_binding (name,value,env):
@@ -640,11 +3338,131 @@ def initial_env ():
                                EPrimCall(oper_print,[EId("x")]),
                                []),
                       env)
+    env = add_binding("pmap",
+                      VClosure(["f","n"],
+                               EPrimCall(oper_pmap,[EId("f"),EId("n")]),
+                               []),
+                      env)
     return env
 
+def initial_need_env ():
+    # initial_env() for engine need, whose pmap applies its function
+    # with eval_need
+    pmap = VClosure(["f","n"],EPrimCall(oper_pmap_need,[EId("f"),EId("n")]),[])
+    return [ (name,pmap if name == "pmap" else v) for (name,v) in initial_env() ]
+
+def initial_frame_env ():
+    # the global scope and frame for eval_frame, built from initial_env()
+    # top-level definitions append a name to the scope and a value to the frame
+    names = []
+    slots = []
+    for (name,f) in initial_env():
+        body = f._body.resolve(Scope(f._params))
+        names.append(name)
+        # an empty frame rather than none marks a closure of the frame engines
+        slots.append(VClosure(f._params,body,[],frame=Frame([])))
+    return (Scope(names),Frame(slots))
+
+LIST_ENGINES = ("iter","cont","need")
+FRAME_ENGINES = ("frame","closure","vm","unboxed")
+
+def eval_top (exp,env,engine,stats=None,optimize=False,typ=None,profile=None):
+    # evaluate a top-level expression in the global environment of the engine
+    # typ is the type of exp, which only engine unboxed uses
+    # profile is the EvalProfile that engine iter counts in, if any
+    if optimize:
+        exp = optimize_top(exp,env,engine)
+    if engine == "iter":
+        if profile is not None:
+            return eval_iter_profiled(exp,env,profile)
+        return exp.eval(env)
+    elif engine == "cont":
+        return eval_cont(exp,env,stats)
+    elif engine == "need":
+        return eval_need(exp,env)
+    elif engine == "frame":
+        (scope,frame) = env
+        return eval_frame(exp.resolve(scope),frame)
+    elif engine == "closure":
+        (scope,frame) = env
+        return eval_compiled(exp.resolve(scope),frame)
+    elif engine == "vm":
+        (scope,frame) = env
+        return eval_vm(exp.resolve(scope),frame)
+    elif engine == "unboxed":
+        (scope,frame) = env
+        return eval_unboxed(exp.resolve(scope),frame,typ)
+    raise Exception("Unknown engine {}".format(engine))
+
+def disassemble_top (exp,env,engine,optimize=False):
+    # #dis on the name of a function shows the code of that function,
+    # anything else shows the code of the expression itself
+    if optimize:
+        exp = optimize_top(exp,env,engine)
+    if engine in LIST_ENGINES:
+        if exp.expForm == "EId":
+            v = dict(env).get(exp._id)
+            if isinstance(v,VClosure):
+                # the closure runs its body unresolved, so compile it
+                # here, in a scope built from the environment it captured
+                fun = EFunction(v._params,v._body,name=v._name)
+                rfun = fun.resolve(Scope([ name for (name,w) in v._env ]))
+                return disassemble(compile_bytecode(rfun._body,rfun._params,rfun._name))
+        scope = Scope([ name for (name,v) in env ])
+        return disassemble(compile_bytecode(exp.resolve(scope)))
+    (scope,frame) = env
+    rexp = exp.resolve(scope)
+    if rexp.expForm == "ELocal":
+        v = eval_frame(rexp,frame)
+        if isinstance(v,VClosure):
+            return disassemble(closure_bytecode(v))
+    return disassemble(compile_bytecode(rexp))
+
+def profile_top (action,profile,engine):
+    # #profile [on|off|reset]: profiling covers eval_iter, so engine iter
+    if action == "on":
+        profile.enabled = True
+        if engine != "iter":
+            return "[Profiling on, but only engine iter is profiled]"
+        return "[Profiling on]"
+    elif action == "off":
+        profile.enabled = False
+        return "[Profiling off]"
+    elif action == "reset":
+        profile.reset()
+        return "[Profile reset]"
+    return profile.report()
+
+def memo_top (action,memo,engine):
+    # #memo [on|off|reset]: engine need calls functions on thunks,
+    # which a cache cannot compare
+    if action == "on":
+        if engine == "need":
+            return "[Memoization is not available under engine need]"
+        memo.enable(True)
+        return "[Memoization on]"
+    elif action == "off":
+        memo.enable(False)
+        return "[Memoization off]"
+    elif action == "reset":
+        memo.reset()
+        return "[Memo caches cleared]"
+    return memo.report()
+
+def define_top (name,value,env,engine):
+    # extend the global environment of the engine
+    if engine in LIST_ENGINES:
+        return add_binding(name,value,env)
+    elif engine in FRAME_ENGINES:
+        (scope,frame) = env
+        scope.names.append(name)
+        frame.slots.append(value)
+        return env
+    raise Exception("Unknown engine {}".format(engine))
+
 def initial_symtable ():
     # keep in sync with initial_env_cps()
-    return [("+",TFunction([TInteger(),TInteger()],TInteger())),
+    return PMap().update([("+",TFunction([TInteger(),TInteger()],TInteger())),
             ("-",TFunction([TInteger(),TInteger()],TInteger())),
             ("*",TFunction([TInteger(),TInteger()],TInteger())),
             ("zero?",TFunction([TInteger()],TBoolean())),
@@ -654,44 +3472,513 @@ def initial_symtable ():
             ("ref",TFunction([TInteger()],TRef(TInteger()))),
             ("deref",TFunction([TRef(TInteger())],TInteger())),
             ("update!",TFunction([TRef(TInteger()),TInteger()],TNone())),
-            ("print!",TFunction([TInteger()],TNone()))]
+            ("print!",TFunction([TInteger()],TNone())),
+            ("pmap",TFunction([TFunction([TInteger()],TGen("S")),TInteger()],
+                              TFunction([TInteger()],TGen("S"))))])
 
 def search_table(t, table):
-    for (name,typ) in reversed(table):
-        if name == t.type_name:
-            return typ
-    return False
+    return table.get(t.type_name,False)
+
+
+#
+# Interpreter sessions
+#
+# an Interpreter holds what the shell keeps between two inputs: the
+# global environment of its engine, the symbol table of the checker,
+# the memoized functions and the profile of its evaluations; sessions
+# share no mutable state, so a program can keep several of them and
+# reuse them across requests
+# the exceptions are the cache of parse(), which only holds what any
+# session would compute (see parse_cache), and set_parser(), which picks
+# the parser of the sessions created without one
+
+class Interpreter (object):
+
+    def __init__ (self,engine="iter",checker="typecheck",optimize=True,parser=None):
+        if engine not in LIST_ENGINES + FRAME_ENGINES:
+            raise Exception("Unknown engine {}".format(engine))
+        if parser is not None and parser not in PARSERS:
+            raise Exception("Unknown parser {}".format(parser))
+        self.engine = engine
+        self.checker = checker
+        self.optimize = optimize
+        # None uses the parser of set_parser()
+        self.parser = parser
+        self.reset()
+
+    def reset (self):
+        # forget every definition
+        if self.engine in FRAME_ENGINES:
+            self.env = initial_frame_env()
+        elif self.engine == "need":
+            self.env = initial_need_env()
+        else:
+            self.env = initial_env()
+        self.symt = initial_symtable()
+        # the known_primitives() of env, kept up to date by bind()
+        self.prims = known_primitives(self.env,self.engine)
+        self.memo = Memoizer()
+        self.profile = EvalProfile()
+        # generic top-level functions, and the names of their copies
+        self.generics = {}
+        self.instances = {}
+
+    def typecheck (self,exp,symt=None):
+        # the type of exp in the session, or in symt
+        if symt is None:
+            symt = self.symt
+        return typecheck_cached(exp,symt,self.checker)
+
+    def evaluate (self,exp,typ=None,stats=None):
+        # the value of a type checked expression
+        if self.optimize:
+            exp = self.specialize(exp).optimize(self.prims)
+        profile = self.profile if self.profile.enabled else None
+        return eval_top(exp,self.env,self.engine,stats,False,typ,profile)
+
+    def specialize (self,exp):
+        # exp calling copies of the generic functions it uses, see concrete()
+        if not free_ids(exp).intersection(self.generics):
+            return exp
+        ctx = TypeContext(self.symt)
+        try:
+            exp.infer(self.symt,ctx)
+        except Exception:
+            return exp
+        return specialize_exp(exp,ctx.instances,self.instance)
+
+    def instance (self,name,t):
+        # the name of the copy of generic function name at type t
+        if name not in self.generics:
+            return None
+        key = (name,t)
+        if key not in self.instances:
+            # no copy while this one is being made
+            self.instances[key] = None
+            fun = self.generics[name]
+            copy = EFunction(fun._params,fun._body,types=list(t.params),name=fun._name)
+            try:
+                typ = self.typecheck(copy)
+            except Exception:
+                return None
+            if typ is not t:
+                return None
+            copy = self.specialize(copy).optimize(self.prims)
+            copy_name = "{}{}".format(name,t)
+            value = eval_top(copy,self.env,self.engine,None,False,typ)
+            self.memo.define(copy_name,copy,value)
+            self.env = define_top(copy_name,value,self.env,self.engine)
+            bind_primitive(self.prims,copy_name,value)
+            self.symt = self.symt.set(copy_name,typ)
+            self.instances[key] = copy_name
+        return self.instances[key]
+
+    def bind (self,name,exp,value,typ):
+        # add the definition of name as exp, evaluated to value
+        # copies of generic functions that refer to name are out of date
+        for (g,fun) in self.generics.items():
+            if g == name or name in free_ids(fun):
+                del self.generics[g]
+        for key in self.instances.keys():
+            if key[0] not in self.generics:
+                del self.instances[key]
+        if exp.expForm == "EFunction" and instantiate(typ,{}) is not typ:
+            self.generics[name] = exp
+        self.memo.define(name,exp,value)
+        self.env = define_top(name,value,self.env,self.engine)
+        bind_primitive(self.prims,name,value)
+        self.symt = self.symt.set(name,typ)
+
+    def define (self,name,input):
+        # define name as an expression, given as an Exp or as a string
+        exp = input
+        if isinstance(input,basestring):
+            result = parse(input,self.parser)
+            if result["result"] != "expression":
+                raise Exception("Cannot define {} as {}".format(name,input))
+            exp = result["expr"]
+        t = self.typecheck(exp)
+        v = self.evaluate(exp,t)
+        self.bind(name,exp,v,t)
+        return v
+
+    def execute (self,result):
+        # run a parsed top-level form: expressions and definitions give
+        # their value, the commands give the text the shell shows
+        form = result["result"]
+        if form == "expression":
+            return self.evaluate(result["expr"],self.typecheck(result["expr"]))
+        elif form == "function":
+            return self.define(result["name"],result["fun"])
+        elif form == "value":
+            return self.define(result["name"],result["expr"])
+        elif form == "abstract":
+            return str(result["expr"])
+        elif form == "dis":
+            return disassemble_top(result["expr"],self.env,self.engine,self.optimize)
+        elif form == "profile":
+            return profile_top(result["action"],self.profile,self.engine)
+        elif form == "memo":
+            return memo_top(result["action"],self.memo,self.engine)
+        return None
+
+    def eval_string (self,input):
+        # run the forms of input up to #quit, returning the result of the last
+        result = None
+        for form in parse_program(input,self.parser):
+            if form["result"] == "quit":
+                break
+            result = self.execute(form)
+        return result
+
+    def typecheck_string (self,input):
+        # the type of the last expression or definition of input;
+        # the definitions are only visible to the forms that follow them
+        symt = self.symt
+        typ = None
+        for form in parse_program(input,self.parser):
+            if form["result"] == "expression":
+                typ = self.typecheck(form["expr"],symt)
+            elif form["result"] in ("function","value"):
+                exp = form["fun"] if form["result"] == "function" else form["expr"]
+                typ = self.typecheck(exp,symt)
+                symt = symt.set(form["name"],typ)
+        return typ
 
 
-def shell ():
+#
+# Compiled program cache
+#
+# run_program() can keep the parsed and type checked forms of a program
+# in a .pjc file: a header line holding a hash of the program, the
+# checker and this interpreter, then the forms as a compressed pickle
+# any change to one of the three makes the file stale, and it is
+# rewritten on the next run
+#
+# optimize() still runs at evaluation time, since what it does depends
+# on the values bound to the global names
+
+PJC_MAGIC = "PJC1"
+
+# the keys of a parsed form that run_program() uses
+PJC_KEYS = ("result","name","expr","fun","action")
+
+_interpreter_version = None
+
+def interpreter_version ():
+    # a hash of the source of this interpreter, computed once
+    global _interpreter_version
+    if _interpreter_version is None:
+        h = hashlib.sha1(sys.version)
+        with open(os.path.splitext(__file__)[0] + ".py","rb") as f:
+            h.update(f.read())
+        _interpreter_version = h.hexdigest()
+    return _interpreter_version
+
+def cache_path (file):
+    return os.path.splitext(file)[0] + ".pjc"
+
+def cache_key (input,checker):
+    h = hashlib.sha1(interpreter_version())
+    h.update(checker)
+    h.update(input)
+    return h.hexdigest()
+
+def load_cache (path,key):
+    # the (forms,types) cached for key, or None
+    try:
+        with open(path,"rb") as f:
+            if f.readline() != "{} {}\n".format(PJC_MAGIC,key):
+                return None
+            return cPickle.loads(zlib.decompress(f.read()))
+    except Exception:
+        # missing, stale or damaged files are all a miss
+        return None
+
+def save_cache (path,key,forms,types):
+    forms = [ dict([ (k,r[k]) for k in PJC_KEYS if k in r ]) for r in forms ]
+    # concurrent runs each write their own file, and the rename is atomic
+    tmp = "{}.{}".format(path,os.getpid())
+    try:
+        with open(tmp,"wb") as f:
+            f.write("{} {}\n".format(PJC_MAGIC,key))
+            f.write(zlib.compress(cPickle.dumps((forms,types),cPickle.HIGHEST_PROTOCOL)))
+        os.rename(tmp,path)
+    except (IOError,OSError,cPickle.PicklingError):
+        # the cache is only an optimization
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+#
+# Program checking
+#
+# a form can only refer to the definitions before it, so the forms of a
+# program make a graph without cycles, where each form depends on the last
+# definition before it of each name checking it reads (the strongly
+# connected components are single forms)
+# those are the names of checked_names(), but the types of the definitions
+# are not known yet: the generic types a definition brings in are taken
+# from the annotations of the forms it depends on
+# the forms are checked by levels: a level holds the forms whose
+# dependencies are all in earlier levels, so the forms of a level are
+# independent of each other, and they are checked on a pool of processes
+# when the program is large enough
+# pickling expressions takes longer than checking them, so the workers
+# get the forms when they are forked and the tasks only name the forms
+#
+# a form whose dependencies fail is not checked, and the failure reported
+# is that of the first failing form, as when checking the forms in order
+
+CHECK_PARALLEL = 256
+
+def form_exp (result):
+    # the expression that a parsed form type checks, if any
+    if result["result"] == "function":
+        return result["fun"]
+    if result["result"] in ("expression","value"):
+        return result["expr"]
+    return None
+
+def form_dependencies (forms,symt=None):
+    # for each form, the indices of the forms it depends on
+    # symt is the symbol table the program starts from
+    defined = {}
+    gens = []
+    deps = []
+    for (i,result) in enumerate(forms):
+        exp = form_exp(result)
+        own = annotation_names(exp) if exp is not None else frozenset()
+        names = set(free_ids(exp)) | own if exp is not None else set()
+        ds = set()
+        found = set(own)
+        todo = list(names)
+        while todo:
+            name = todo.pop()
+            if name in defined:
+                if defined[name] in ds:
+                    continue
+                ds.add(defined[name])
+                more = gens[defined[name]]
+            else:
+                more = gen_names(symt.get(name)) if symt is not None else frozenset()
+            found.update(more)
+            for n in more - names:
+                names.add(n)
+                todo.append(n)
+        gens.append(frozenset(found))
+        deps.append(sorted(ds))
+        if result["result"] in ("function","value"):
+            defined[result["name"]] = i
+    return deps
+
+def form_levels (deps):
+    # the forms grouped by level, lowest first
+    level = []
+    levels = []
+    for (i,ds) in enumerate(deps):
+        level.append(1 + max([ level[d] for d in ds ]) if ds else 0)
+        if level[i] == len(levels):
+            levels.append([])
+        levels[level[i]].append(i)
+    return levels
+
+# the forms of the program, in the workers of check_program()
+_check_forms = None
+
+def check_worker (forms):
+    global _check_forms
+    _check_forms = forms
+
+def check_chunk (task):
+    (checker,symt,items) = task
+    return check_forms(_check_forms,checker,symt,items)
+
+def check_forms (forms,checker,symt,items):
+    # type check forms, given as (index, the types of the forms it
+    # depends on); returns (index, type, error, time) for each
+    results = []
+    for (i,bindings) in items:
+        exp = form_exp(forms[i])
+        (t,error) = (None,None)
+        with Timer() as timer:
+            try:
+                t = typecheck_top(exp,symt.update(bindings),checker)
+            except Exception as e:
+                error = str(e)
+        results.append((i,t,error,timer.duration_in_seconds()))
+    return results
+
+def check_program (forms,checker,symt,times=None):
+    # the types of the definitions of a program, by form index
+    # symt is the symbol table the program starts from; times, if given,
+    # gets the level and the time taken to check each form, by form index
+    deps = form_dependencies(forms,symt)
+    workers = multiprocessing.cpu_count()
+    pool = None
+    if (len(forms) >= CHECK_PARALLEL and workers > 1 and hasattr(os,"fork") and
+        not multiprocessing.current_process().daemon):
+        pool = multiprocessing.Pool(workers,check_worker,(forms,))
+    types = {}
+    errors = {}
+    try:
+        for (n,level) in enumerate(form_levels(deps)):
+            items = []
+            for i in level:
+                if form_exp(forms[i]) is None:
+                    continue
+                if any([ d in errors for d in deps[i] ]):
+                    errors[i] = None
+                    continue
+                items.append((i,[ (forms[d]["name"],types[d]) for d in deps[i] ]))
+            if pool is not None and len(items) > 1:
+                size = max(1,-(-len(items) // (workers * PMAP_CHUNKS)))
+                tasks = [ (checker,symt,items[lo:lo+size]) for lo in xrange(0,len(items),size) ]
+                chunks = pool.map(check_chunk,tasks,1)
+            else:
+                chunks = [ check_forms(forms,checker,symt,items) ]
+            for chunk in chunks:
+                for (i,t,error,seconds) in chunk:
+                    if error is not None:
+                        errors[i] = error
+                    elif forms[i]["result"] != "expression":
+                        types[i] = t
+                    if times is not None:
+                        times[i] = (n,seconds)
+    finally:
+        if pool is not None:
+            pool.terminate()
+    failed = [ i for i in sorted(errors) if errors[i] is not None ]
+    if failed:
+        raise Exception("Form {}: {}".format(failed[0]+1,errors[failed[0]]))
+    return types
+
+def check_report (forms,times):
+    # the forms by decreasing check time, as filled in by check_program()
+    lines = ["{:<6}{:<20}{:>6}{:>12}{:>8}".format("form","name","level","time","%")]
+    total = sum([ seconds for (level,seconds) in times.values() ])
+    for i in sorted(times,key=lambda i: -times[i][1]):
+        (level,seconds) = times[i]
+        name = forms[i].get("name") or forms[i]["result"]
+        lines.append("{:<6}{:<20}{:>6}{:>11.4f}s{:>7.1f}%".format(i+1,name,level,seconds,
+                                                             100.0*seconds/total if total else 0.0))
+    return "\n".join(lines)
+
+def run_program (input,engine="iter",checker="typecheck",timings=False,optimize=True,cache=None,
+                 check_times=False):
+    # run a whole program without interaction:
+    # parse every form, type check every form, and only then evaluate them
+    # returns the exit status: 0 if all went well, 1 for a parse or type
+    # error (nothing is evaluated), 2 for an error during evaluation
+    #
+    # cache is the path of a .pjc file to load the checked forms from,
+    # or to save them to when it is missing or stale
+    #
+    # check_times prints the time taken to check each form, see check_program()
+    times = []
+    interp = Interpreter(engine,checker,optimize)
+    checked = None
+    if cache is not None:
+        with Timer() as timer:
+            key = cache_key(input,checker)
+            checked = load_cache(cache,key)
+        if checked is not None:
+            times.append(("load cache",timer.duration_in_seconds()))
+
+    if checked is not None:
+        (forms,types) = checked
+    else:
+        try:
+            with Timer() as timer:
+                forms = parse_program(input,interp.parser)
+            times.append(("parse",timer.duration_in_seconds()))
+        except Exception as e:
+            print >> sys.stderr, "Parse error: {}".format(e)
+            return 1
+
+        check = {} if check_times else None
+        with Timer() as timer:
+            try:
+                types = check_program(forms,checker,interp.symt,check)
+            except Exception as e:
+                print >> sys.stderr, e
+                return 1
+        times.append(("typecheck",timer.duration_in_seconds()))
+        if check_times:
+            print >> sys.stderr, check_report(forms,check)
+
+        if cache is not None:
+            save_cache(cache,key,forms,types)
+
+    status = 0
+    with Timer() as timer:
+        for (i,result) in enumerate(forms):
+            try:
+                if result["result"] == "expression":
+                    print interp.evaluate(result["expr"])
+                elif result["result"] == "function":
+                    v = interp.evaluate(result["fun"],types[i])
+                    interp.bind(result["name"],result["fun"],v,types[i])
+                elif result["result"] == "value":
+                    v = interp.evaluate(result["expr"],types[i])
+                    interp.bind(result["name"],result["expr"],v,types[i])
+                elif result["result"] == "quit":
+                    break
+                else:
+                    print interp.execute(result)
+            except Exception as e:
+                print >> sys.stderr, "Form {}: {}".format(i+1,e)
+                status = 2
+                break
+    times.append(("eval",timer.duration_in_seconds()))
+
+    if timings:
+        for (phase,t) in times:
+            print >> sys.stderr, "[{} {:.3f}s]".format(phase,t)
+    return status
+
+
+def shell (engine="iter",checker="typecheck",optimize=True):
     # A simple shell
     # Repeatedly read a line of input, parse it, and evaluate the result
+    #
+    # engine is "iter" (eval_iter over association lists),
+    # "cont" (eval_cont, eval_iter with an explicit continuation stack),
+    # "need" (eval_need, eval_iter with call-by-need arguments),
+    # "frame" (eval_frame over resolved expressions),
+    # "closure" (resolved expressions compiled to Python closures),
+    # "vm" (resolved expressions compiled to bytecode) or
+    # "unboxed" (closures over raw ints and bools where the types allow)
+    #
+    # checker is "typecheck" (the typecheck() methods) or
+    # "infer" (type inference by unification)
+    #
+    # optimize runs optimize() on every form before evaluating it
 
     print "Lecture 10 - REF Language with static type checking"
-    print "#quit to quit, #abs to see abstract representation"
-    env = initial_env()
-    symt = initial_symtable()
+    print "#quit to quit, #abs to see abstract representation, #dis to see bytecode"
+    print "#profile [on|off|reset] to profile evaluation"
+    print "#memo [on|off|reset] to cache the results of pure functions"
+    interp = Interpreter(engine,checker,optimize)
         
     while True:
         inp = raw_input("ref/types> ")
 
         try:
-            global typetable
-            typetable = symt
-            result = parse(inp)
+            result = parse(inp,interp.parser)
             print result
 
             if result["result"] == "expression":
                 exp = result["expr"]
 
-                typ = exp.typecheck(symt)
+                typ = interp.typecheck(exp)
                 print "[Type {}]".format(typ)
-                v = exp.eval(env)
+                stats = {}
+                v = interp.evaluate(exp,stats=stats)
                 print v
-
-            elif result["result"] == "abstract":
-                exp = result["expr"]
-                print exp
+                if "max_depth" in stats:
+                    print "[Max depth {}]".format(stats["max_depth"])
 
             elif result["result"] == "quit":
                 return
@@ -700,22 +3987,23 @@ def shell ():
                 # the top-level environment is special, it is shared
                 # amongst all the top-level closures so that all top-level
                 # functions can refer to each other
-                f = EFunction(result["params"],result["body"],types=result["types"],name=result["name"])
-                t = f.typecheck(symt)
+                f = result["fun"]
+                t = interp.typecheck(f)
                 print "[Type {}]".format(t)
-                v = f.eval(env)
-
-                env = add_binding(result["name"],v,env)
-                symt = add_binding(result["name"],t,symt)
+                v = interp.evaluate(f,t)
+                interp.bind(result["name"],f,v,t)
                 print "{} defined".format(result["name"])
 
             elif result["result"] == "value":
                 exp = result["expr"]
-                t = exp.typecheck(symt)
-                v = exp.eval(env)
-                env = add_binding(result["name"],v,env)
-                symt = add_binding(result["name"],t,symt)
+                t = interp.typecheck(exp)
+                v = interp.evaluate(exp,t)
+                interp.bind(result["name"],exp,v,t)
                 print "{} defined".format(result["name"])
+
+            else:
+                # #abs, #dis, #profile and #memo
+                print interp.execute(result)
                 
         except Exception as e:
             print "Exception: {}".format(e)
@@ -727,7 +4015,18 @@ def shell ():
 # types
 
 
+_type_lock = threading.Lock()
+
 class Type (object):
+    # types are never mutated once created, so they are shared:
+    # atomic types are singletons and function and reference types are
+    # hash-consed (see TFunction), which makes equality an identity check
+    # types are created under _type_lock so that two threads checking at
+    # the same time cannot make two copies of one type
+    #
+    # a type is ground if it contains no TAny, TGen, TVar or TUnknown,
+    # the only types whose equality is not identity
+    ground = True
     def isInteger (self):
         return False
     def isBoolean (self):
@@ -745,41 +4044,67 @@ class Type (object):
     def isGen (self):
         return False
 
-class TInteger (Type):
-    def __init__ (self):
-        self.type = "integer"
+class AtomicType (Type):
+    # one instance per class
+    def __new__ (cls):
+        instance = cls.__dict__.get("_instance")
+        if instance is None:
+            with _type_lock:
+                instance = cls.__dict__.get("_instance")
+                if instance is None:
+                    instance = Type.__new__(cls)
+                    cls._instance = instance
+        return instance
+    def __reduce__ (self):
+        return (self.__class__,())
+
+class TInteger (AtomicType):
+    type = "integer"
     def __str__ (self):
         return "int"
     def isInteger (self):
         return True
     def isEqual (self,t):
-        return (t.isInteger() or t.isAny())
+        return (t is self or t.isInteger() or t.isAny())
 
-class TBoolean (Type):
-    def __init__ (self):
-        self.type = "boolean"
+class TBoolean (AtomicType):
+    type = "boolean"
     def __str__ (self):
         return "bool"
     def isBoolean (self):
         return True
     def isEqual (self,t):
-        return (t.isBoolean() or t.isAny())
+        return (t is self or t.isBoolean() or t.isAny())
 
-class TNone (Type):
-    def __init__ (self):
-        self.type = "none"
+class TNone (AtomicType):
+    type = "none"
     def __str__ (self):
         return "none"
     def isNone (self):
         return True
     def isEqual (self,t):
-        return (t.isNone() or t.isAny())
+        return (t is self or t.isNone() or t.isAny())
 
 class TFunction (Type):
-    def __init__ (self,params,result):
-        self.type = "function"
-        self.params = params
-        self.result = result
+    type = "function"
+    # (ids of params, id of result) -> type
+    _table = weakref.WeakValueDictionary()
+    def __new__ (cls,params,result):
+        params = tuple(params)
+        key = (tuple([ id(p) for p in params ]),id(result))
+        t = cls._table.get(key)
+        if t is None:
+            with _type_lock:
+                t = cls._table.get(key)
+                if t is None:
+                    t = Type.__new__(cls)
+                    t.params = params
+                    t.result = result
+                    t.ground = all([ p.ground for p in params ]) and result.ground
+                    cls._table[key] = t
+        return t
+    def __reduce__ (self):
+        return (TFunction,(self.params,self.result))
     def __str__ (self):
         params = []
         for t in self.params:
@@ -795,6 +4120,8 @@ class TFunction (Type):
     def isFunction (self):
         return True
     def isEqual (self,t):
+        if self.ground and t.ground:
+            return t is self
         if t.isAny():
             return True
         if not t.isFunction():
@@ -803,22 +4130,50 @@ class TFunction (Type):
         return args and self.result.isEqual(t.result)
 
 class TRef (Type):
-    def __init__ (self,content):
-        self.type = "ref"
-        self.content = content
+    type = "ref"
+    # id of content -> type
+    _table = weakref.WeakValueDictionary()
+    def __new__ (cls,content):
+        t = cls._table.get(id(content))
+        if t is None:
+            with _type_lock:
+                t = cls._table.get(id(content))
+                if t is None:
+                    t = Type.__new__(cls)
+                    t.content = content
+                    t.ground = content.ground
+                    cls._table[id(content)] = t
+        return t
+    def __reduce__ (self):
+        return (TRef,(self.content,))
     def __str__ (self):
         return "(ref {})".format(self.content)
     def isRef (self):
         return True
     def isEqual (self,t):
+        if self.ground and t.ground:
+            return t is self
         return (t.isRef() and self.content.isEqual(t.content)) or t.isAny()
 
 #The gen type is the generic type that we can create for the function
 #It can be name as any generic type(type name). eg type T or S
 class TGen(Type):
-    def __init__ (self,type_name):
-        self.type = "gen"
-        self.type_name = type_name #type T for example
+    type = "gen"
+    ground = False
+    # type name -> type
+    _table = weakref.WeakValueDictionary()
+    def __new__ (cls,type_name):
+        t = cls._table.get(type_name)
+        if t is None:
+            with _type_lock:
+                t = cls._table.get(type_name)
+                if t is None:
+                    t = Type.__new__(cls)
+                    t.type_name = type_name #type T for example
+                    cls._table[type_name] = t
+        return t
+    def __reduce__ (self):
+        return (TGen,(self.type_name,))
     def __str__ (self):
         return "gen"
     def isGen (self):
@@ -832,9 +4187,9 @@ class TGen(Type):
 # It is used as the initial result type for a recursive function when
 #  type checking the body of the recursive function
 
-class TAny (Type):
-    def __init__ (self):
-        self.type = "any"
+class TAny (AtomicType):
+    type = "any"
+    ground = False
     def __str__ (self):
         return "any"
     def isAny (self):
@@ -843,14 +4198,67 @@ class TAny (Type):
         return True
     
 
+# A type variable of the inference engine (see unify())
+# instance is the type it has been bound to, if any
+# the only mutable type, so never shared
+class TVar (Type):
+    ground = False
+    def __init__ (self,name=None):
+        self.type = "var"
+        self.name = name
+        self.instance = None
+    def __str__ (self):
+        if self.instance is not None:
+            return str(self.instance)
+        return "<{}>".format(self.name or "?")
+    def isEqual (self,t):
+        return prune(self).isEqual(t) if self.instance is not None else False
+
 # useful as a placeholder -- this will always fail
-class TUnknown (Type):
-    def __init__ (self):
-        self.type = "???"
+class TUnknown (AtomicType):
+    type = "???"
+    ground = False
     def __str__ (self):
         return "???"
     def isEqual (self,t):
         # Unknown is never equal to anything
         return False
 
-shell()
+
+
+def main (argv):
+    # python final.py [options] [file]
+    # without a file, start the shell; with - read the program from stdin
+    import argparse
+    parser = argparse.ArgumentParser(description="FUNC with polymorphic types")
+    parser.add_argument("file",nargs="?",
+                        help="program to run instead of starting the shell (- for stdin)")
+    parser.add_argument("--engine",default="iter",choices=LIST_ENGINES+FRAME_ENGINES)
+    parser.add_argument("--checker",default="typecheck",choices=("typecheck","infer"))
+    parser.add_argument("--time",action="store_true",
+                        help="print the time taken by each phase of the program")
+    parser.add_argument("--no-optimize",dest="optimize",action="store_false",
+                        help="evaluate the forms as parsed, without optimize()")
+    parser.add_argument("--parser",default="reader",choices=PARSERS,
+                        help="the hand-written reader, or the pyparsing grammar")
+    parser.add_argument("--no-cache",dest="cache",action="store_false",
+                        help="neither read nor write the .pjc file of the program")
+    parser.add_argument("--check-times",action="store_true",
+                        help="print the time taken to type check each form")
+    args = parser.parse_args(argv)
+    set_parser(args.parser)
+    if args.file is None:
+        shell(args.engine,args.checker,args.optimize)
+        return 0
+    cache = None
+    if args.file == "-":
+        input = sys.stdin.read()
+    else:
+        with open(args.file) as f:
+            input = f.read()
+        if args.cache:
+            cache = cache_path(args.file)
+    return run_program(input,args.engine,args.checker,args.time,args.optimize,cache,args.check_times)
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,238 @@
+############################################################
+# Checks of final.py
+#
+#   python finaltest.py [NAME ...]
+#
+# runs every test_ function of this file, or the ones whose name
+# contains one of the NAMEs, and exits with status 1 if any fails
+# a test fails by raising an exception, usually an AssertionError
+# saying what differed
+
+import gc
+import sys
+import traceback
+import multiprocessing
+
+import final
+
+
+############################################################
+# program checking
+#
+# check_program() checks the forms of a program by dependency levels,
+# in parallel; it has to find what checking them in order finds
+
+# programs on which check_program() once disagreed with checking in order
+CHECK_REGRESSIONS = [
+    # under typecheck(), the global a shadows the parameter of the let
+    "(define a true) (let ((a 1)) (int) (+ a 1))",
+    "(define a 5) (let ((a 1)) (int) (+ a 1)) (define a true) (let ((a 1)) (int) (+ a 1))",
+    "(define a true) (let ((a 1)) (int) (+ a 1)) (define a 5) (let ((a 1)) (int) (+ a 1))",
+    "(defun f (x) (int) x) (defun g (y) (int) (f y)) (defun f (x) (bool) x) (g 1) (f true)",
+    "(define x 1) (defun f (x) (bool) x) (f true) (define x true)",
+    # under typecheck(), the generic types of map are looked up as names
+    "(defun add1 (a) (int) (+ a 1)) (defun map (a b) (<T> (-> (<T>) <S>)) (b a)) (define T true) (map 3 add1)",
+    "(defun add1 (a) (int) (+ a 1)) (defun map (a b) (<T> (-> (<T>) <S>)) (b a)) (define S true) (map 3 add1)",
+    "(defun istrue (a) (bool) a) (defun map (a b) (<T> (-> (<T>) <S>)) (b a)) (define g map) (define T 5) (g true istrue)",
+    "(define T true) ((function (x) (<T>) x) 3)",
+    "(define S true) (pmap (function (x) (int) x) 3)",
+]
+
+def check_in_order (forms,checker,symt):
+    # what check_program() computes, checking the forms one after the other
+    types = {}
+    for (i,result) in enumerate(forms):
+        exp = final.form_exp(result)
+        if exp is None:
+            continue
+        try:
+            t = final.typecheck_top(exp,symt,checker)
+        except Exception as e:
+            raise Exception("Form {}: {}".format(i+1,e))
+        if result["result"] != "expression":
+            types[i] = t
+            symt = symt.set(result["name"],t)
+    return types
+
+def check_outcome (check,forms,checker):
+    # the types check() finds for forms, or its error
+    try:
+        return sorted([ (i,str(t)) for (i,t) in check(forms,checker,final.initial_symtable()).items() ])
+    except Exception as e:
+        return str(e)
+
+def test_check_program ():
+    # check_program() agrees with check_in_order() under both checkers
+    for input in CHECK_REGRESSIONS:
+        forms = final.parse_program(input)
+        for checker in ("typecheck","infer"):
+            expected = check_outcome(check_in_order,forms,checker)
+            got = check_outcome(final.check_program,forms,checker)
+            assert got == expected, "{} [{}]: expected {}, got {}".format(input,checker,expected,got)
+
+# the type memoized on an expression must go stale when a binding the
+# checker reads changes, including one named like a generic type
+CACHED_PROGRAM = [
+    "(defun add1 (a) (int) (+ a 1))",
+    "(defun istrue (a) (bool) a)",
+    "(defun map (a b) (<T> (-> (<T>) <S>)) (b a))",
+]
+
+CACHED_REGRESSIONS = [
+    ("(map 3 add1)", "(define T true)"),
+    ("(map 3 add1)", "(define S true)"),
+    ("(map true istrue)", "(define T 5)"),
+    ("((function (x) (<T>) x) 3)", "(define T true)"),
+]
+
+def check_outcome_top (exp,symt,checker):
+    # the type typecheck_top() finds for exp, or its error
+    try:
+        return str(final.typecheck_top(exp,symt,checker))
+    except Exception as e:
+        return str(e)
+
+def test_typecheck_cached ():
+    # typecheck_cached() agrees with checking afresh after a new binding
+    for (input,define) in CACHED_REGRESSIONS:
+        for checker in ("typecheck","infer"):
+            symt = final.initial_symtable()
+            for form in CACHED_PROGRAM + [input, define]:
+                result = final.parse(form)
+                exp = final.form_exp(result)
+                if form == input:
+                    cached = exp
+                    final.typecheck_cached(exp,symt,checker)
+                elif result["result"] != "expression":
+                    symt = symt.set(result["name"],final.typecheck_top(exp,symt,checker))
+            try:
+                got = str(final.typecheck_cached(cached,symt,checker))
+            except Exception as e:
+                got = str(e)
+            expected = check_outcome_top(final.parse(input)["expr"],symt,checker)
+            assert got == expected, "{} after {} [{}]: expected {}, got {}".format(input,define,checker,expected,got)
+
+
+############################################################
+# engine need
+#
+# accumulating parameters grow chains of thunks as long as the loop;
+# forcing them must not take a Python frame per iteration, whatever
+# the accumulator goes through
+
+NEED_PROGRAM = [
+    "(defun add1 (a) (int) (+ a 1))",
+    "(defun id (x) (<T>) x)",
+    "(defun map (a b) (<T> (-> (<T>) <S>)) (b a))",
+    "(defun pick (c a b) (bool <T> <T>) (if c a b))",
+    "(defun loop (n) (int) (loop n))",
+    "(defun first (a b) (int int) a)",
+    # through a primitive, a generic function, a function argument
+    # and a conditional
+    "(defun sumacc (n acc) (int int) (if (zero? n) acc (sumacc (- n 1) (+ acc (id n)))))",
+    "(defun run (n acc) (int int) (if (zero? n) acc (run (- n 1) (map acc add1))))",
+    "(defun pickacc (n acc) (int int) (if (zero? n) acc (pickacc (- n 1) (+ (id acc) (pick true n 0)))))",
+    "(defun cnt (n acc) (int int) (if (zero? n) acc (cnt (- n 1) (if (zero? n) 0 (add1 acc)))))",
+]
+
+NEED_RESULTS = [
+    ("(sumacc 5000 0)", "12502500"),
+    ("(run 5000 0)", "5000"),
+    ("(pickacc 5000 0)", "12502500"),
+    ("(cnt 5000 0)", "5000"),
+    # arguments that are not needed are not evaluated
+    ("(first 1 (loop 0))", "1"),
+    ("(pick true 2 (loop 0))", "2"),
+    ("(first (pick false (loop 0) 3) (loop 0))", "3"),
+]
+
+def test_need_chains ():
+    interp = final.Interpreter("need",checker="infer")
+    for form in NEED_PROGRAM:
+        interp.eval_string(form)
+    for (input,expected) in NEED_RESULTS:
+        got = str(interp.eval_string(input))
+        assert got == expected, "{}: expected {}, got {}".format(input,expected,got)
+
+
+############################################################
+# pmap
+#
+# pmap pickles its function to worker processes; with a single CPU it
+# runs the function inline, so the tests ask for two workers
+
+PMAP_PROGRAM = [
+    # closures capturing an int, which engine unboxed keeps raw
+    "(defun cs (k) (int) (pmap (function (i) (int) (+ i k)) 40))",
+    "(defun ct (k b) (int bool) (pmap (function (i) (int) (if b (* i k) 0)) 40))",
+    "(defun named (k) (int) (pmap (function rec (i) (int) (if (zero? i) k (+ 1 (rec (- i 1))))) 40))",
+]
+
+PMAP_RESULTS = [
+    ("((cs 10) 3)", "13"),
+    ("((ct 10 true) 3)", "30"),
+    ("((named 100) 30)", "130"),
+]
+
+def test_pmap_workers ():
+    # every engine gets the same results from a pool of two workers
+    saved = final.PMAP_WORKERS
+    final.PMAP_WORKERS = 2
+    try:
+        for engine in final.FRAME_ENGINES + final.LIST_ENGINES:
+            interp = final.Interpreter(engine,checker="infer")
+            for form in PMAP_PROGRAM:
+                interp.eval_string(form)
+            for (input,expected) in PMAP_RESULTS:
+                got = str(interp.eval_string(input))
+                assert got == expected, "{} [{}]: expected {}, got {}".format(input,engine,expected,got)
+            assert multiprocessing.active_children(), "[{}]: pmap did not start workers".format(engine)
+    finally:
+        final.PMAP_WORKERS = saved
+
+
+############################################################
+# types
+#
+# types are interned, but the tables must not keep them alive: a long
+# session meets any number of generic type names
+
+def test_type_tables ():
+    # interned types go away with their last reference
+    assert final.TGen("T") is final.TGen("T")
+    gc.collect()
+    before = (len(final.TGen._table),len(final.TFunction._table))
+    for i in xrange(1000):
+        final.TFunction([final.TGen("G{}".format(i))],final.TInteger())
+    gc.collect()
+    after = (len(final.TGen._table),len(final.TFunction._table))
+    assert after <= before, "tables grew from {} to {}".format(before,after)
+
+
+############################################################
+# running the checks
+
+def tests (names=None):
+    found = [ (name,f) for (name,f) in sorted(globals().items())
+              if name.startswith("test_") and callable(f) ]
+    if names:
+        found = [ (name,f) for (name,f) in found if any([ n in name for n in names ]) ]
+    return found
+
+def main (argv):
+    failures = 0
+    for (name,f) in tests(argv):
+        try:
+            f()
+        except Exception:
+            failures += 1
+            print "FAIL", name
+            traceback.print_exc(file=sys.stdout)
+        else:
+            print "ok  ", name
+    print "{} failed".format(failures) if failures else "all passed"
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))